@@ -0,0 +1,396 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import generate_newgrf as gen
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Constants to modify
+ROW_COUNTS = [10000, 100000, 1000000]  # Rows in the generated allCountries file, up to 12 million
+SEED = 20240101  # The generated data only depends on the seed and the row count
+TARGETS = ["", "US", "US.NY", "GB.ENG.GLA", "FR"]  # Built end to end and checked against the golden output
+REGRESSION_TOLERANCE = 0.2  # A stage is reported as slower when it takes this much longer than the baseline
+PARTITION_CHECK_COUNT = 2000  # Town cache partitions of the check that a world target reads them within FILE_LIMIT
+PARTITION_CHECK_FILE_LIMIT = 256  # Open files allowed while the world target of that check is read
+NATIVE_CHECK_ROWS = 20000  # Rows of the data the native backend is compared with nmlc on
+NATIVE_CHECK_TARGETS = ["US", "CH", "GB.ENG.GLA"]  # US has over 255 names, CH gets a country name that is not ASCII
+
+# Constants to not modify
+# (code, name, demonym, share of rows, region codes); the first region of a country gets the most rows
+COUNTRIES = [
+    ("US", "United States", "American", 0.30, ["NY", "CA", "TX", "MA", "VT"]),
+    ("RU", "Russia", "Russian", 0.15, ["48", "47", "66"]),
+    ("FR", "France", "French", 0.12, ["11", "84", "52"]),
+    ("DE", "Germany", "German", 0.10, ["02", "07", "16"]),
+    ("GB", "United Kingdom", "British", 0.10, ["ENG", "SCT", "WLS", "NIR"]),
+    ("IT", "Italy", "Italian", 0.08, ["09", "07"]),
+    ("ES", "Spain", "Spanish", 0.07, ["29", "56"]),
+    ("SE", "Sweden", "Swedish", 0.04, ["26", "28"]),
+    ("NL", "Netherlands", "Dutch", 0.03, ["07", "11"]),
+    ("CH", "Switzerland", "Swiss", 0.01, ["ZH", "BE"]),
+]
+SUBREGIONS = {("GB", "ENG"): ["GLA", "E1", "K4"], ("US", "NY"): ["061", "047", "081"]}
+NAME_PARTS = ["Ash", "Brook", "Castle", "Dun", "El", "Fair", "Glen", "Hol", "Kings", "Lake", "Mar", "New", "North",
+              "Saint ", "St. ", "Le ", "San ", "O'", "Mc", "Ober", "Nieder", "Val", "Ville", "Ström", "Øster", "Zü",
+              "Île-", "Bad ", "\"Old\" ", "Neu"]
+NAME_ENDINGS = ["ton", "ham", "ford", "by", "wick", "ville", "burg", "berg", "dorf", "hausen", "ley", "mouth",
+                "stead", "sur-Mer", "holm", "ås", "ów", "gorod", "sk", "o", "a"]
+FEATURE_CODES = [("P", "PPL", 0.22), ("P", "PPLA", 0.01), ("P", "PPLX", 0.02), ("H", "STM", 0.25),
+                 ("T", "MT", 0.2), ("S", "SCH", 0.2), ("A", "ADM3", 0.1)]
+ADMIN2_CODES = [("GB", "ENG", "GLA", "Greater London"), ("GB", "ENG", "E1", "Kent"),
+                ("GB", "ENG", "K4", "Surrey"), ("US", "NY", "061", "New York County"),
+                ("US", "NY", "047", "Kings County"), ("US", "NY", "081", "Queens County")]
+
+
+# Functions
+
+
+def make_name_pool(rnd, size):
+    # Many places share a name, as in the real data, so the pool is much smaller than the number of rows
+    return ["".join(rnd.choice(NAME_PARTS) for _ in range(rnd.randint(1, 2))) + rnd.choice(NAME_ENDINGS)
+            for _ in range(size)]
+
+
+def generate_dataset(data_path, rows, seed=SEED):
+    """
+    Writes GeoNames style metadata, country files and allCountries.txt with the given number of rows
+    to data_path. Returns the number of rows written to each data file, keyed by path.
+    """
+    rnd = random.Random(seed)
+    os.makedirs(os.path.join(data_path, "Data"), exist_ok=True)
+    with open(os.path.join(data_path, "countryInfo.txt"), "w", encoding="utf-8") as f:
+        f.write("#ISO\tISO3\tISO-Numeric\tfips\tCountry\tCapital\tArea(in sq km)\tPopulation\tContinent\n")
+        for country_code, name, _, share, _ in COUNTRIES:
+            f.write(f"{country_code}\t{country_code}X\t0\t{country_code}\t{name}\t\t0\t{int(share * 1e9)}\tEU\n")
+    with open(os.path.join(data_path, "admin1CodesASCII.txt"), "w", encoding="utf-8") as f:
+        for country_code, _, _, _, region_codes in COUNTRIES:
+            for region_code in region_codes:
+                f.write(f"{country_code}.{region_code}\tRegion {region_code}\tRegion {region_code}\t0\n")
+    with open(os.path.join(data_path, "admin2Codes.txt"), "w", encoding="utf-8") as f:
+        for country_code, region_code, subregion_code, name in ADMIN2_CODES:
+            f.write(f"{country_code}.{region_code}.{subregion_code}\t{name}\t{name}\t0\n")
+    with open(os.path.join(data_path, "countries.csv"), "w", encoding="utf-8") as f:
+        for country_code, _, demonym, _, _ in COUNTRIES:
+            columns = [""] * (gen.DEMONYM_COUNTRY_DEMONYM_COLUMN + 1)
+            columns[gen.DEMONYM_COUNTRY_CODE_COLUMN] = country_code
+            columns[gen.DEMONYM_COUNTRY_DEMONYM_COLUMN] = demonym
+            f.write(",".join(f'"{column}"' for column in columns) + "\n")
+
+    name_pool = make_name_pool(rnd, max(100, rows // 8))
+    country_weights = [share for _, _, _, share, _ in COUNTRIES]
+    feature_weights = [share for _, _, share in FEATURE_CODES]
+    merged_path = os.path.join(data_path, "allCountries.txt")
+    country_paths = {country_code: os.path.join(data_path, "Data", f"{country_code}.txt")
+                     for country_code, _, _, _, _ in COUNTRIES}
+    row_counts = dict.fromkeys([merged_path, *country_paths.values()], 0)
+    country_files = {country_code: open(path, "w", encoding="utf-8") for country_code, path in country_paths.items()}
+    with open(merged_path, "w", encoding="utf-8") as merged_file, contextlib.ExitStack() as stack:
+        for f in country_files.values():
+            stack.enter_context(f)
+        for geonameid in range(1, rows + 1):
+            country_code, _, _, _, region_codes = rnd.choices(COUNTRIES, country_weights)[0]
+            region_code = region_codes[min(int(rnd.expovariate(1.5)), len(region_codes) - 1)]
+            subregion_code = rnd.choice(SUBREGIONS.get((country_code, region_code), [""]))
+            feature_class, feature_code = rnd.choices(FEATURE_CODES, feature_weights)[0][:2]
+            # Zipf-like reuse of names, and a heavy tailed population where most places have none recorded
+            name = name_pool[min(int(rnd.paretovariate(0.8)) - 1, len(name_pool) - 1) if rnd.random() < 0.3
+                             else rnd.randrange(len(name_pool))]
+            population = int(rnd.paretovariate(1.2) * 200) if rnd.random() < 0.35 else 0
+            row = [str(geonameid), name, name, "", f"{rnd.uniform(-60, 70):.5f}", f"{rnd.uniform(-180, 180):.5f}",
+                   feature_class, feature_code, country_code, "", region_code, subregion_code, "", "",
+                   str(population), "", "0", "Etc/UTC", "2024-01-01"]
+            line = "\t".join(row) + "\n"
+            merged_file.write(line)
+            country_files[country_code].write(line)
+            row_counts[merged_path] += 1
+            row_counts[country_paths[country_code]] += 1
+    return row_counts
+
+
+def configure(work_path, data_path, **settings):
+    # Points the generator at the benchmark directories so nothing is downloaded or deployed elsewhere
+    source_files_path = os.path.join(work_path, "Source_Files")
+    os.makedirs(source_files_path, exist_ok=True)
+    with open(os.path.join(source_files_path, "license.txt"), "w", encoding="utf-8") as f:
+        f.write("Benchmark placeholder license\n")
+    gen.apply_settings({
+        "DATA_PATH": data_path,
+        "CACHE_PATH": os.path.join(work_path, "Cache"),
+        "SOURCE_FILES_PATH": source_files_path,
+        "OUTPUT_PATH": os.path.join(work_path, "Output"),
+        "ID_FILE": os.path.join(work_path, "file_id.txt"),
+        "USE_OPENTTD_DIR": False,
+        "NEWGRF_BACKEND": "native",
+        "FORCE_REBUILD": True,
+        "VERBOSE_OUTPUT": False,
+        **settings,
+    })
+
+
+def get_benchmark_stages(work_path, data_path, row_counts):
+    # (name, function) pairs run in order; every function returns the number of rows it processed
+    merged_path = os.path.join(data_path, "allCountries.txt")
+    country_path = os.path.join(data_path, "Data", "US.txt")
+    targets = [gen.split_input(code) for code in TARGETS if code == "" or code.startswith("US")]
+    state = {}
+
+    def scan_text():
+        configure(work_path, data_path, USE_TOWN_CACHE=False)
+        state["records"] = gen.read_and_process_towns(merged_path, "", [], "")
+        return row_counts[merged_path]
+
+    def build_cache():
+        configure(work_path, data_path)
+        gen.build_town_cache(merged_path)
+        gen.build_town_cache(country_path)
+        return row_counts[merged_path] + row_counts[country_path]
+
+    def scan_cache():
+        configure(work_path, data_path)
+        gen.read_and_process_towns_for_targets(merged_path, targets)
+        return row_counts[merged_path]
+
+    def sort_records():
+        gen.sort_town_records(state["records"], gen.SORT_BY_POPULATION)
+        return len(state["records"])
+
+    def score_records():
+        state["weights"], _ = gen.score_town_records(state["records"], gen.WEIGHT_CURVE)
+        return len(state["records"])
+
+    def write_nml():
+        gen.write_nml_file(os.path.join(work_path, "benchmark.nml"), "TA01", 1, state["records"], state["weights"])
+        return len(state["records"])
+
+    def end_to_end():
+        configure(work_path, data_path)
+        rows = 0
+        for code in TARGETS:
+            target = gen.split_input(code)
+            gen.process_country_region(*target)
+            rows += row_counts[os.path.join(data_path, gen.get_data_file_name(target[0]).replace(".zip", ".txt"))]
+        return rows
+
+    return [
+        ("scan_text", scan_text),
+        ("build_cache", build_cache),
+        ("scan_cache", scan_cache),
+        ("sort", sort_records),
+        ("score", score_records),
+        ("write_nml", write_nml),
+        ("end_to_end", end_to_end),
+    ]
+
+
+def run_stages(stages, repeat, trace_memory):
+    results = {}
+    for name, stage in stages:
+        best = None
+        for _ in range(repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                rows = stage()
+                seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        results[name] = {"rows": rows, "seconds": round(best, 4),
+                         "rows_per_second": round(rows / best) if best else None}
+    if trace_memory:
+        # A separate pass, as tracing allocations slows every stage down
+        tracemalloc.start()
+        for name, stage in stages:
+            tracemalloc.reset_peak()
+            with contextlib.redirect_stdout(io.StringIO()):
+                stage()
+            results[name]["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results
+
+
+def build_golden_outputs(work_path, data_path, fast):
+    # Builds every target either the straightforward way (no cache, one scan per target) or the fast way
+    # (town cache and a single scan for all targets) and returns the NML files by target
+    configure(work_path, data_path, USE_TOWN_CACHE=fast, MULTI_TARGET_SCAN=fast)
+    targets = [gen.split_input(code) for code in TARGETS]
+    outputs = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        target_records = gen.read_towns_for_targets(targets) if fast else [None] * len(targets)
+        for code, target, town_records in zip(TARGETS, targets, target_records):
+            gen.process_country_region(*target, town_records)
+            location_dir = gen.get_location_dir(*target)
+            with open(os.path.join(gen.SOURCE_FILES_PATH, location_dir, f"{location_dir}.nml"), "rb") as f:
+                outputs[code] = f.read()
+    return outputs
+
+
+def check_golden_outputs(work_path, data_path):
+    # Returns the NML hashes of the fast path, and the targets where it differs from the straightforward path
+    reference = build_golden_outputs(os.path.join(work_path, "reference"), data_path, fast=False)
+    fast = build_golden_outputs(os.path.join(work_path, "fast"), data_path, fast=True)
+    mismatches = [code for code in TARGETS if reference[code] != fast[code]]
+    return {code: hashlib.sha256(fast[code]).hexdigest() for code in TARGETS}, mismatches
+
+
+def check_many_partitions(work_path):
+    # Reads a world target from a town cache with many more partitions than files that may be open at once.
+    # Returns a problem, or None when the cached rows match a plain scan.
+    data_path = os.path.join(work_path, "Data")
+    os.makedirs(data_path, exist_ok=True)
+    merged_path = os.path.join(data_path, "allCountries.txt")
+    with open(merged_path, "w", encoding="utf-8") as f:
+        for geonameid in range(1, PARTITION_CHECK_COUNT * 2 + 1):
+            country_code = COUNTRIES[geonameid % len(COUNTRIES)][0]
+            row = [str(geonameid), f"Town {geonameid}", "", "", "0", "0", "P", "PPL", country_code, "",
+                   f"R{geonameid % PARTITION_CHECK_COUNT}", "", "", "", str(geonameid % 97), "", "0", "Etc/UTC",
+                   "2024-01-01"]
+            f.write("\t".join(row) + "\n")
+    configure(work_path, data_path, USE_TOWN_CACHE=False)
+    reference = list(gen.read_and_process_towns(merged_path, "", [], ""))
+    configure(work_path, data_path, USE_TOWN_CACHE=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        gen.build_town_cache(merged_path)
+    limits = resource.getrlimit(resource.RLIMIT_NOFILE) if resource is not None else None
+    try:
+        if limits is not None:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(PARTITION_CHECK_FILE_LIMIT, limits[1]), limits[1]))
+        cached = list(gen.read_and_process_towns(merged_path, "", [], ""))
+    except OSError as e:
+        return f"World target of a {PARTITION_CHECK_COUNT} partition town cache failed: {e}"
+    finally:
+        if limits is not None:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+    if cached != reference:
+        return f"World target of a {PARTITION_CHECK_COUNT} partition town cache differs from a plain scan"
+    return None
+
+
+def check_native_backend(work_path):
+    # Builds the same targets with nmlc and with the native backend. Returns the targets whose GRFs differ,
+    # or None when nmlc is not installed.
+    if shutil.which("nmlc") is None:
+        return None
+    data_path = os.path.join(work_path, "Data")
+    generate_dataset(data_path, NATIVE_CHECK_ROWS)
+    # The lang strings of CH then need unicode escapes, the other targets get ASCII ones
+    country_info_path = os.path.join(data_path, "countryInfo.txt")
+    with open(country_info_path, "r", encoding="utf-8") as f:
+        country_info = f.read()
+    with open(country_info_path, "w", encoding="utf-8") as f:
+        f.write(country_info.replace("\tSwitzerland\t", "\tSchwëiz/Suisse/Svizzera\t"))
+    grfs = {}
+    for backend in ("nmlc", "native"):
+        configure(os.path.join(work_path, backend), data_path, NEWGRF_BACKEND=backend, USE_TOWN_CACHE=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for code in NATIVE_CHECK_TARGETS:
+                target = gen.split_input(code)
+                gen.process_country_region(*target)
+                location_dir = gen.get_location_dir(*target)
+                with open(os.path.join(gen.SOURCE_FILES_PATH, location_dir, f"{location_dir}.grf"), "rb") as f:
+                    grfs[backend, code] = f.read()
+    return [code for code in NATIVE_CHECK_TARGETS if grfs["nmlc", code] != grfs["native", code]]
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    # Prints the change of every stage against the baseline and returns a list of problems found
+    problems = []
+    for rows, run in results.items():
+        baseline_run = baseline.get(rows)
+        if baseline_run is None or baseline_run["seed"] != run["seed"]:
+            print(f"{rows} rows: no baseline with the same seed")
+            continue
+        for code, nml_hash in run["nml_sha256"].items():
+            if baseline_run.get("nml_sha256", {}).get(code, nml_hash) != nml_hash:
+                problems.append(f"{rows} rows: NML of {code or 'World'} differs from the baseline")
+        for stage, result in run["stages"].items():
+            baseline_result = baseline_run["stages"].get(stage)
+            if baseline_result is None:
+                continue
+            change = result["seconds"] / baseline_result["seconds"] - 1 if baseline_result["seconds"] else 0
+            memory = ""
+            if "peak_bytes" in result and "peak_bytes" in baseline_result:
+                memory = f", peak memory {result['peak_bytes'] / 2 ** 20:.1f} MiB " \
+                         f"(was {baseline_result['peak_bytes'] / 2 ** 20:.1f} MiB)"
+            print(f"{rows} rows {stage}: {result['seconds']:.3f}s, {change:+.0%} against baseline{memory}")
+            if change > tolerance:
+                problems.append(f"{rows} rows: {stage} is {change:.0%} slower than the baseline")
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark generate_newgrf.py on generated GeoNames data and check its output.")
+    parser.add_argument("--rows", type=int, nargs="+", default=ROW_COUNTS, metavar="N",
+                        help="rows in the generated allCountries file, one benchmark per count")
+    parser.add_argument("--repeat", type=int, default=1, metavar="N",
+                        help="run every stage N times and keep the fastest")
+    parser.add_argument("--seed", type=int, default=SEED, help="seed of the generated data")
+    parser.add_argument("--work-dir", metavar="DIR",
+                        help="keep the generated data and outputs in DIR instead of a temporary directory")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory pass")
+    parser.add_argument("--baseline", metavar="FILE", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE, metavar="FRACTION",
+                        help="report stages that are this much slower than the baseline")
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON, for use as a later baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    work_root = args.work_dir or tempfile.mkdtemp(prefix="taby_benchmark_")
+    results = {}
+    problems = []
+    try:
+        for rows in args.rows:
+            run_path = os.path.join(work_root, str(rows))
+            data_path = os.path.join(run_path, "Data")
+            if os.path.exists(run_path):
+                shutil.rmtree(run_path)
+            print(f"Generating {rows:,} rows")
+            row_counts = generate_dataset(data_path, rows, args.seed)
+            stages = get_benchmark_stages(os.path.join(run_path, "stages"), data_path, row_counts)
+            stage_results = run_stages(stages, args.repeat, not args.no_memory)
+            for stage, result in stage_results.items():
+                memory = f", peak {result['peak_bytes'] / 2 ** 20:.1f} MiB" if "peak_bytes" in result else ""
+                print(f"  {stage:<12} {result['seconds']:>9.3f}s {result['rows_per_second'] or 0:>12,} rows/s"
+                      f"{memory}")
+            nml_hashes, mismatches = check_golden_outputs(os.path.join(run_path, "golden"), data_path)
+            for code in mismatches:
+                problems.append(f"{rows} rows: fast path NML of {code or 'World'} differs from the reference path")
+            results[str(rows)] = {"seed": args.seed, "stages": stage_results, "nml_sha256": nml_hashes}
+        problem = check_many_partitions(os.path.join(work_root, "partitions"))
+        if problem is not None:
+            problems.append(problem)
+        mismatches = check_native_backend(os.path.join(work_root, "native"))
+        if mismatches is None:
+            print("nmlc is not installed, the native backend was not compared with it")
+        for code in mismatches or []:
+            problems.append(f"Native GRF of {code or 'World'} differs from the one nmlc compiles")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            problems.extend(compare_with_baseline(results, json.load(f), args.tolerance))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
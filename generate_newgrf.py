@@ -1,9 +1,47 @@
+import argparse
+import concurrent.futures
+import contextlib
+import cProfile
 import csv
-import ctypes.wintypes
+import functools
+import hashlib
+import heapq
+import http.server
+import io
+import json
 import math
 import os
+import pickle
+import random
+import re
+import shutil
+import sqlite3
+import struct
 import subprocess
-from datetime import datetime
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
+from array import array
+from datetime import datetime, timedelta, timezone
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows, peak memory is then left out of the build report
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows, deployments then never use reflinks
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None  # Only available on Windows, where file_id.txt is locked with it instead of fcntl
 
 # Constants to modify
 DATA_INPUT = [
@@ -39,6 +77,30 @@ MERGED_FILE_OVERRIDE = False
 USE_OPENTTD_DIR = True
 MAX_TOWNS = 16320  # Aprox due to OpenTTD limit (127 * 128)
 VERBOSE_OUTPUT = False # Set to True for more detailed output
+MULTI_TARGET_SCAN = True  # Read each data file once for all targets that use it
+USE_TOWN_CACHE = True  # Ingest data files once into a partitioned cache of populated places
+FORCE_REBUILD = False  # Rebuild targets even when their build manifest says nothing changed
+NEWGRF_BACKEND = "nmlc"  # "nmlc" to compile the NML, or "native" to write the GRF directly without nmlc
+BUILD_JOBS = 1  # Number of targets built in parallel
+STREAM_FROM_ZIP = True  # Keep downloaded GeoNames zips and read them directly instead of extracting them
+WEIGHT_CURVE = "fourth_root"  # How population maps to spawn chance: "fourth_root", "log", "rank" or an exponent
+PROFILE_SLOWEST_TARGET = False  # Profile every target and keep the cProfile output of the slowest one
+DOWNLOAD_JOBS = 4  # Number of data files downloaded at the same time
+REFRESH_DATA = False  # Ask the server whether downloaded data files changed and fetch the ones that did
+UPDATE_DATA = False  # Apply the GeoNames daily modification and deletion files to the downloaded data files
+TOWN_NAME_LANGUAGES = []  # GeoNames language codes such as "ja"; each target also gets a GRF per language
+COLLAPSE_NEAR_DUPLICATES = False  # Keep only the most populous of names that differ in case, accents or abbreviations
+FUZZY_NEAR_DUPLICATES = False  # With COLLAPSE_NEAR_DUPLICATES, also collapse long names one typo apart
+WORLD_QUOTAS = None  # "proportional", "capped" or "sqrt" to share MAX_TOWNS of the world target between countries
+WORLD_QUOTA_STRATUM = "country"  # "country", or "admin1" to also share each country quota between its regions
+WORLD_QUOTA_CAP = 0.05  # With "capped" world quotas, the largest share of MAX_TOWNS a single country gets
+WORLD_QUOTA_SEED = 0  # Decides which of equally entitled countries or regions get the towns left by rounding
+EXTRA_DEPLOY_DIRS = []  # More directories every GRF is deployed to, besides the OpenTTD or Output directory
+DEPLOY_HARDLINKS = True  # Deploy GRFs as hardlinks when the destination is on the same file system
+BUILD_PIPELINE = True  # With BUILD_JOBS 1, overlap downloads, scans and nmlc compiles of different targets
+PIPELINE_COMPILE_JOBS = 2  # nmlc processes the build pipeline runs at the same time
+PIPELINE_QUEUE_SIZE = 4  # Prepared targets the build pipeline holds before scanning waits for the compiles
+SERVER_CACHE_SIZE = 128  # Generated NML and GRF files the build server keeps in memory
 
 # Constants to not modify
 COLUMN_FEATURE_TYPE = "P"
@@ -50,8 +112,14 @@ COLUMN_FEATURE_TYPE_LOC = 6
 COLUMN_TYPE_SUB_TYPE_LOC = 7
 COLUMN_POPULATION = 14
 COLUMN_NAME = 1
+COLUMN_LATITUDE = 4
+COLUMN_LONGITUDE = 5
+EARTH_RADIUS_KM = 6371.0088
 BASE_PATH = os.path.dirname(os.path.realpath(__file__))
 DATA_PATH = os.path.join(BASE_PATH, "Data")
+SOURCE_FILES_PATH = os.path.join(BASE_PATH, "Source_Files")
+OUTPUT_PATH = os.path.join(BASE_PATH, "Output")  # Deploy directory when USE_OPENTTD_DIR is False
+OPENTTD_DIR = None  # Deploy directory when USE_OPENTTD_DIR is True, found per platform when not set
 DATA_URL = "https://download.geonames.org/export/dump/"
 LIST_OF_DATA_FILES = [
     "countryInfo.txt",
@@ -68,6 +136,56 @@ DEMONYM_COUNTRY_CODE_COLUMN = 3
 DEMONYM_COUNTRY_DEMONYM_COLUMN = 72
 NEWGRF_LICENSE_URL = "https://www.gnu.org/licenses/old-licenses/gpl-2.0.txt"
 ID_FILE = os.path.join(BASE_PATH, "file_id.txt")
+ID_LOCK_TIMEOUT = 60  # Seconds to wait for another build to release file_id.txt
+TOWN_CACHE_LOCK_TIMEOUT = 3600  # Seconds to wait for another process to build the same town cache
+BUILD_MANIFEST_FILE = "build_manifest.json"
+BUILD_REPORT_FILE = "build_report.json"  # Timings of the last run, written to SOURCE_FILES_PATH
+PROFILE_FILE = "build_profile.prof"  # cProfile output of the slowest target, written to SOURCE_FILES_PATH
+GENERATOR_VERSION = 1  # Bump whenever a change to this script changes the generated NML or lang files
+CACHE_PATH = os.path.join(DATA_PATH, "Cache")
+TOWN_CACHE_VERSION = 3
+TOWN_CACHE_MANIFEST = "manifest.json"
+SPATIAL_INDEX_FILE = "spatial_index.pkl"  # Grid cells of the town cache mapped to the partitions with towns in them
+SPATIAL_GRID_DEGREES = 1.0  # Size of a spatial index grid cell in degrees of latitude and longitude
+TOWN_CACHE_FLUSH_ROWS = 500000  # Rows buffered in memory during ingest before partitions are flushed
+PERSIST_METADATA_REGISTRY = True  # Keep parsed metadata files as pickle snapshots in the cache
+DOWNLOAD_STATE_FILE = "download_state.json"  # ETag, Last-Modified, size and hash of every download, kept in DATA_PATH
+DOWNLOAD_RETRIES = 3  # Attempts per file; interrupted transfers resume where they stopped
+DOWNLOAD_TIMEOUT = 60  # Seconds without data before a transfer is retried
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+WEIGHT_CURVES = ["fourth_root", "log", "rank"]
+DATA_UPDATE_STATE_FILE = "update_state.json"  # Date of the last applied daily update, kept in DATA_PATH
+COLUMN_GEONAMEID = 0
+# Words replaced when town names are compared for near duplicates, after accents and case are removed
+TOWN_NAME_ABBREVIATIONS = {
+    "st": "saint",
+    "ste": "sainte",
+    "sankt": "saint",
+    "sta": "santa",
+    "sto": "santo",
+    "mt": "mount",
+    "ft": "fort",
+}
+FUZZY_NAME_MIN_LENGTH = 8  # Shorter normalized names are only collapsed when they are equal
+WORLD_QUOTA_MODES = ["proportional", "capped", "sqrt"]
+WORLD_QUOTA_REGION_SLACK = 2  # Region heaps of "admin1" world quotas keep this many times their share so far
+COLUMN_COUNTRY_POPULATION = 7  # In countryInfo.txt
+SERVER_GRF_ID_CHARACTERS = "0123456789abcdefghijklmnopqrstuvwxyz"
+FICLONE = 0x40049409  # Linux ioctl that makes a copy-on-write clone (reflink) of a file
+ALTERNATE_NAMES_FILE = "alternateNamesV2.zip"
+ALTERNATE_NAMES_INDEX_FILE = "alternate_names.sqlite"  # (geonameid, language) to preferred name, kept in CACHE_PATH
+ALTERNATE_NAMES_INDEX_VERSION = 1
+ALTERNATE_NAMES_BATCH_ROWS = 100000  # Rows inserted into the index per statement batch
+ALTERNATE_NAMES_QUERY_IDS = 500  # Geonameids looked up per query, below the SQLite variable limit
+ALTERNATE_NAMES_COLUMN_GEONAMEID = 1
+ALTERNATE_NAMES_COLUMN_LANGUAGE = 2
+ALTERNATE_NAMES_COLUMN_NAME = 3
+ALTERNATE_NAMES_COLUMN_PREFERRED = 4
+ALTERNATE_NAMES_COLUMN_SHORT = 5
+ALTERNATE_NAMES_COLUMN_COLLOQUIAL = 6
+ALTERNATE_NAMES_COLUMN_HISTORIC = 7
+# Codes in the language column that are not languages
+ALTERNATE_NAMES_PSEUDO_LANGUAGES = {"post", "link", "iata", "icao", "faac", "abbr", "wkdt", "unlc", "tcid", "fr_1793"}
 
 NML_BOILERPLATE = """grf {{
     grfid: "{grf_id}";
@@ -88,30 +206,255 @@ STR_GRF_DESC                    :{ORANGE}Taby [COUNTRY_NAME_A] Town Names {BLUE}
 STR_GRF_URL                     :https://github.com/tabytac/Taby_Town_Names
 STR_GAME_OPTIONS_TOWN_NAME      :Taby [COUNTRY_NAME_A] Town Names
 """
+GRF_CONTAINER_HEADER = b"\x00\x00GRF\x82\x0d\x0a\x1a\x0a"
+GRF_STRING_UNICODE_PREFIX = b"\xc3\x9e"  # "Þ", marks a UTF-8 string
+GRF_DEFAULT_LANGUAGE = 0x7F
+# String commands without arguments that the native backend understands, as (unicode, ascii) escapes like nmlc
+GRF_STRING_COMMANDS = {
+    "": (r"\0D", r"\0D"),
+    "{": ("{", "{"),
+    "NBSP": (r"\U00A0", None),
+    "COPYRIGHT": (r"\U00A9", r"\A9"),
+    "TRAIN": (r"\UE0B4", r"\B4"),
+    "LORRY": (r"\UE0B5", r"\B5"),
+    "BUS": (r"\UE0B6", r"\B6"),
+    "PLANE": (r"\UE0B7", r"\B7"),
+    "SHIP": (r"\UE0B8", r"\B8"),
+    "TINYFONT": (r"\0E", r"\0E"),
+    "BIGFONT": (r"\0F", r"\0F"),
+    "BLUE": (r"\UE088", r"\88"),
+    "SILVER": (r"\UE089", r"\89"),
+    "GOLD": (r"\UE08A", r"\8A"),
+    "RED": (r"\UE08B", r"\8B"),
+    "PURPLE": (r"\UE08C", r"\8C"),
+    "LTBROWN": (r"\UE08D", r"\8D"),
+    "ORANGE": (r"\UE08E", r"\8E"),
+    "GREEN": (r"\UE08F", r"\8F"),
+    "YELLOW": (r"\UE090", r"\90"),
+    "DKGREEN": (r"\UE091", r"\91"),
+    "CREAM": (r"\UE092", r"\92"),
+    "BROWN": (r"\UE093", r"\93"),
+    "WHITE": (r"\UE094", r"\94"),
+    "LTBLUE": (r"\UE095", r"\95"),
+    "GRAY": (r"\UE096", r"\96"),
+    "DKBLUE": (r"\UE097", r"\97"),
+    "BLACK": (r"\UE098", r"\98"),
+    "PUSH_COLOUR": (r"\UE09A\1F", r"\9A\1F"),
+    "POP_COLOUR": (r"\UE09A\20", r"\9A\20"),
+}
 
 
 # Functions
 
 
-def get_openttd_dir():
-    buffer = ctypes.create_unicode_buffer(ctypes.wintypes.MAX_PATH)
-    ctypes.windll.shell32.SHGetFolderPathW(None, 5, None, 0, buffer)
-    return os.path.join(buffer.value, "OpenTTD", "newgrf",
-                        "Taby_Town_Names")
+# Settings that can be set from a config file or the command line, and are copied to worker processes
+CONFIGURABLE_SETTINGS = [
+    "DATA_INPUT",
+    "SORT_BY_POPULATION",
+    "POPULATION_THRESHOLD",
+    "MERGED_FILE_OVERRIDE",
+    "USE_OPENTTD_DIR",
+    "MAX_TOWNS",
+    "WEIGHT_CURVE",
+    "VERBOSE_OUTPUT",
+    "MULTI_TARGET_SCAN",
+    "USE_TOWN_CACHE",
+    "STREAM_FROM_ZIP",
+    "DOWNLOAD_JOBS",
+    "REFRESH_DATA",
+    "UPDATE_DATA",
+    "TOWN_NAME_LANGUAGES",
+    "COLLAPSE_NEAR_DUPLICATES",
+    "FUZZY_NEAR_DUPLICATES",
+    "WORLD_QUOTAS",
+    "WORLD_QUOTA_STRATUM",
+    "WORLD_QUOTA_CAP",
+    "WORLD_QUOTA_SEED",
+    "EXTRA_DEPLOY_DIRS",
+    "DEPLOY_HARDLINKS",
+    "BUILD_PIPELINE",
+    "PIPELINE_COMPILE_JOBS",
+    "SERVER_CACHE_SIZE",
+    "FORCE_REBUILD",
+    "NEWGRF_BACKEND",
+    "BUILD_JOBS",
+    "PROFILE_SLOWEST_TARGET",
+    "PERSIST_METADATA_REGISTRY",
+    "DATA_PATH",
+    "CACHE_PATH",
+    "SOURCE_FILES_PATH",
+    "OUTPUT_PATH",
+    "OPENTTD_DIR",
+    "ID_FILE",
+    "DATA_URL",
+]
+
+
+class BuildStats:
+    """Wall and CPU time per stage and row and byte counters, collected while a target or a scan runs."""
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {"rows_scanned": 0, "rows_kept": 0, "bytes_read": 0, "names_localized": 0}
+        self.peak_rss_growth = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+            stage["calls"] += 1
+            stage["wall_seconds"] += time.perf_counter() - wall_start
+            stage["cpu_seconds"] += time.process_time() - cpu_start
+
+    def report(self):
+        stages = {name: {"calls": stage["calls"], "wall_seconds": round(stage["wall_seconds"], 4),
+                         "cpu_seconds": round(stage["cpu_seconds"], 4)} for name, stage in self.stages.items()}
+        # The peak RSS is of the whole process so far. The growth is how far the peak rose while this target
+        # or scan was collecting, which is its own peak for the largest target of a run and 0 for smaller ones.
+        peak_rss = get_peak_rss()
+        return {"stages": stages, **self.counters,
+                "peak_rss_growth_bytes": self.peak_rss_growth if peak_rss is not None else None,
+                "process_peak_rss_bytes": peak_rss}
+
+
+_BUILD_STATS = threading.local()  # .stats is the BuildStats of the target or scan running in each thread
+
+
+@contextlib.contextmanager
+def collect_build_stats(stats=None):
+    # Collects into stats, or into new BuildStats, in the current thread
+    previous = getattr(_BUILD_STATS, "stats", None)
+    stats = _BUILD_STATS.stats = stats if stats is not None else BuildStats()
+    peak_rss = get_peak_rss()
+    try:
+        yield stats
+    finally:
+        _BUILD_STATS.stats = previous
+        if peak_rss is not None:
+            stats.peak_rss_growth += get_peak_rss() - peak_rss
+
+
+def run_with_build_stats(stats, function, *args):
+    # Runs function in an executor thread with stats collecting
+    with collect_build_stats(stats):
+        return function(*args)
+
 
+def timed_stage(function):
+    # Records the calls of a pipeline stage in the running BuildStats, if any
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stats = getattr(_BUILD_STATS, "stats", None)
+        if stats is None:
+            return function(*args, **kwargs)
+        with stats.stage(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
 
-OPENTTD_DIR = (get_openttd_dir() if input(
-    "Do you want to use the default OpenTTD directory? (yes = y, no = n): ")
-               == "y" else
-               input("Enter the directory where the GRF should be copied: "))
+
+def count_build_stat(name, amount):
+    stats = getattr(_BUILD_STATS, "stats", None)
+    if stats is not None:
+        stats.counters[name] += amount
+
+
+def get_peak_rss():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def get_openttd_dir():
+    if sys.platform == "win32":
+        import ctypes.wintypes
+        buffer = ctypes.create_unicode_buffer(ctypes.wintypes.MAX_PATH)
+        ctypes.windll.shell32.SHGetFolderPathW(None, 5, None, 0, buffer)
+        openttd_dir = os.path.join(buffer.value, "OpenTTD")
+    elif sys.platform == "darwin":
+        openttd_dir = os.path.join(os.path.expanduser("~"), "Documents", "OpenTTD")
+    elif os.path.isdir(os.path.join(os.path.expanduser("~"), ".openttd")):
+        openttd_dir = os.path.join(os.path.expanduser("~"), ".openttd")
+    else:
+        data_home = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+        openttd_dir = os.path.join(data_home, "openttd")
+    return os.path.join(openttd_dir, "newgrf", "Taby_Town_Names")
+
+
+def get_deploy_dir():
+    global OPENTTD_DIR
+    if not USE_OPENTTD_DIR:
+        os.makedirs(OUTPUT_PATH, exist_ok=True)
+        return OUTPUT_PATH
+    if OPENTTD_DIR is None:
+        OPENTTD_DIR = get_openttd_dir()
+    return OPENTTD_DIR
+
+
+def get_deploy_dirs():
+    deploy_dir = get_deploy_dir()
+    return [deploy_dir] + [extra_dir for extra_dir in EXTRA_DEPLOY_DIRS if extra_dir != deploy_dir]
+
+
+def ask_openttd_dir():
+    return (get_openttd_dir() if input(
+        "Do you want to use the default OpenTTD directory? (yes = y, no = n): ")
+            == "y" else
+            input("Enter the directory where the GRF should be copied: "))
+
+
+# Parsed metadata files shared by every target in the run, keyed by file path
+_METADATA_REGISTRY = {}
+
+
+def parse_geonames_codes(f):
+    codes = {}
+    for line in f:
+        columns = line.split("\t")
+        codes.setdefault(columns[0], columns)
+    return codes
+
+
+def parse_country_demonyms(f):
+    demonyms = {}
+    for columns in csv.reader(f):
+        if len(columns) > max(DEMONYM_COUNTRY_CODE_COLUMN, DEMONYM_COUNTRY_DEMONYM_COLUMN):
+            demonyms.setdefault(columns[DEMONYM_COUNTRY_CODE_COLUMN].strip('"').strip("'"),
+                                columns[DEMONYM_COUNTRY_DEMONYM_COLUMN].strip('"').strip("'"))
+    return demonyms
+
+
+def load_metadata_index(file_path, parse):
+    if file_path in _METADATA_REGISTRY:
+        return _METADATA_REGISTRY[file_path]
+    stat = os.stat(file_path)
+    snapshot_path = os.path.join(CACHE_PATH, "metadata", os.path.basename(file_path) + ".pkl")
+    index = None
+    if PERSIST_METADATA_REGISTRY and os.path.exists(snapshot_path):
+        with open(snapshot_path, "rb") as f:
+            size, mtime_ns, snapshot_index = pickle.load(f)
+        if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            index = snapshot_index
+    if index is None:
+        with open(file_path, "r", encoding="utf-8") as f:
+            index = parse(f)
+        if PERSIST_METADATA_REGISTRY:
+            os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+            with open(snapshot_path + ".tmp", "wb") as f:
+                pickle.dump((stat.st_size, stat.st_mtime_ns, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(snapshot_path + ".tmp", snapshot_path)
+    _METADATA_REGISTRY[file_path] = index
+    return index
 
 
 def get_name(code, file_path, column_index):
-    with open(file_path, "r", encoding="utf-8") as f:
-        for line in f:
-            columns = line.split("\t")
-            if columns[0] == code:
-                return columns[column_index]
+    columns = load_metadata_index(file_path, parse_geonames_codes).get(code)
+    if columns is not None:
+        return columns[column_index]
 
 
 def get_country_region_subregion_names(country_code, region_code, subregion_code):
@@ -138,11 +481,7 @@ def get_country_region_subregion_names(country_code, region_code, subregion_code
 def get_country_demonym(country_code):
     if not os.path.exists(os.path.join(DATA_PATH, "countries.csv")):
         download_data_files("countries.csv", GITHUB_COUNTRY_DEMONYM_URL)
-    with open(os.path.join(DATA_PATH, "countries.csv"), "r", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        for columns in reader:
-            if country_code == columns[DEMONYM_COUNTRY_CODE_COLUMN].strip('"').strip("'"):
-                return columns[DEMONYM_COUNTRY_DEMONYM_COLUMN].strip('"').strip("'")
+    return load_metadata_index(os.path.join(DATA_PATH, "countries.csv"), parse_country_demonyms).get(country_code)
 
 
 def prepare_output_dir(output_dir):
@@ -153,29 +492,18 @@ def prepare_output_dir(output_dir):
     if not os.path.exists(os.path.join(output_dir, "lang", "english.lng")):
         with open(os.path.join(output_dir, "lang", "english.lng"), "w", encoding="utf-8") as file:
             file.write(LANG_FILE_BOILERPLATE)
-    if not os.path.exists(os.path.join(BASE_PATH, "Source_Files", "license.txt")):
-        print("Downloading license file")
-        subprocess.run(
-            [
-                "curl",
-                "-o",
-                os.path.join(BASE_PATH, "Source_Files", "license.txt"),
-                NEWGRF_LICENSE_URL,
-            ],
-            check=True,
-        )
+    fetch_license_file()
     if not os.path.exists(os.path.join(output_dir, "license.txt")):
         if VERBOSE_OUTPUT:
             print("Copying license file")
-        subprocess.run(
-            [
-                "copy",
-                os.path.join(BASE_PATH, "Source_Files", "license.txt"),
-                os.path.join(output_dir, "license.txt"),
-            ],
-            shell=True,
-            check=True,
-        )
+        install_file(os.path.join(SOURCE_FILES_PATH, "license.txt"), output_dir)
+
+
+def fetch_license_file():
+    # Fetched in fetch_shared_data before targets are built, so parallel builds never download it together
+    if not os.path.exists(os.path.join(SOURCE_FILES_PATH, "license.txt")):
+        print("Downloading license file")
+        download_files([(NEWGRF_LICENSE_URL, os.path.join(SOURCE_FILES_PATH, "license.txt"), False)])
 
 
 def to_precision(num, sig_figs):
@@ -185,26 +513,11 @@ def to_precision(num, sig_figs):
     return 0
 
 
-def update_language_file(
-        output_dir,
-        country_code,
-        region_codes,
-        subregion_code,
-        version,
-        num_towns,
-        lowest_population,
-):
-    lang_file_path = os.path.join(output_dir, "lang", "english.lng")
-    # if the lang file not exits, make the folder, then english.lng file
-    if not os.path.exists(lang_file_path):
-        os.makedirs(os.path.join(output_dir, "lang"), exist_ok=True)
-        with open(lang_file_path, "w", encoding="utf-8") as file:
-            file.write("/* Taby Town Names */\n")
-            file.write('STR_GRF_NAME: "Taby Town Names"\n')
-            file.write('STR_GRF_DESC: "Adds a large number of town names to OpenTTD."\n')
-            file.write('STR_GRF_URL: "\n')
-    with open(lang_file_path, "r", encoding="utf-8") as file:
-        content = file.read()
+def get_target_display_names(country_code, region_codes, subregion_code):
+    # Returns the names used for [COUNTRY_NAME_A] (e.g. "British England") and [COUNTRY_NAME_B] in the lang file
+    area = get_geo_area(country_code)
+    if area is not None:
+        return area.label, area.description
 
     # Handle multiple regions
     if isinstance(region_codes, list) and len(region_codes) > 1:
@@ -233,7 +546,35 @@ def update_language_file(
     if country_demonym_a == "None":
         country_demonym_a = "World"
         country_demonym_b = "the World"
+    return country_demonym_a, country_demonym_b
+
+
+@timed_stage
+def update_language_file(
+        output_dir,
+        country_code,
+        region_codes,
+        subregion_code,
+        version,
+        num_towns,
+        lowest_population,
+        language=None,
+):
+    lang_file_path = os.path.join(output_dir, "lang", "english.lng")
+    # if the lang file not exits, make the folder, then english.lng file
+    if not os.path.exists(lang_file_path):
+        os.makedirs(os.path.join(output_dir, "lang"), exist_ok=True)
+        with open(lang_file_path, "w", encoding="utf-8") as file:
+            file.write("/* Taby Town Names */\n")
+            file.write('STR_GRF_NAME: "Taby Town Names"\n')
+            file.write('STR_GRF_DESC: "Adds a large number of town names to OpenTTD."\n')
+            file.write('STR_GRF_URL: "\n')
+    with open(lang_file_path, "r", encoding="utf-8") as file:
+        content = file.read()
 
+    country_demonym_a, country_demonym_b = get_target_display_names(country_code, region_codes, subregion_code)
+    if language is not None:
+        country_demonym_a = f"{country_demonym_a} ({language})"
     current_date = datetime.now().strftime("%Y-%m-%d")
 
     content = content.replace("[COUNTRY_NAME_A]", country_demonym_a)
@@ -246,168 +587,1823 @@ def update_language_file(
         file.write(content)
 
 
-def read_and_process_towns(file_path, country_code, region_codes, subregion_code):
-    # Normalize region_codes to a list
+def normalize_region_codes(region_codes):
     if isinstance(region_codes, str):
-        region_codes = [region_codes] if region_codes else []
-    elif region_codes is None:
-        region_codes = []
+        return [region_codes] if region_codes else []
+    if region_codes is None:
+        return []
+    return region_codes
+
+
+class GeoArea:
+    """
+    Target selecting towns by location instead of admin codes, parsed from "bbox:south,west,north,east[:label]"
+    or "radius:latitude,longitude,km[:label]". A bounding box with west > east crosses the antimeridian.
+    """
+
+    def __init__(self, code):
+        kind, _, rest = code.partition(":")
+        values, _, label = rest.partition(":")
+        try:
+            numbers = [float(value) for value in values.split(",")]
+        except ValueError:
+            numbers = []
+        if not all(map(math.isfinite, numbers)):
+            numbers = []
+        self.kind = kind
+        self.center = None
+        self.radius_km = None
+        if (kind == "bbox" and len(numbers) == 4 and -90.0 <= numbers[0] <= numbers[2] <= 90.0
+                and all(-180.0 <= longitude <= 180.0 for longitude in numbers[1::2])):
+            self.south, self.west, self.north, self.east = numbers
+            default_label = f"{self.south:g}, {self.west:g} to {self.north:g}, {self.east:g}"
+        elif (kind == "radius" and len(numbers) == 3 and -90.0 <= numbers[0] <= 90.0
+              and -180.0 <= numbers[1] <= 180.0 and numbers[2] > 0):
+            latitude, longitude, self.radius_km = numbers
+            self.center = (latitude, longitude)
+            # Bounding box of the circle, used to pick grid cells and to reject most rows before the exact distance
+            latitude_delta = math.degrees(self.radius_km / EARTH_RADIUS_KM)
+            self.south, self.north = max(latitude - latitude_delta, -90.0), min(latitude + latitude_delta, 90.0)
+            if self.south == -90.0 or self.north == 90.0:
+                self.west, self.east = -180.0, 180.0
+            else:
+                longitude_delta = math.degrees(math.asin(min(1.0, math.sin(self.radius_km / EARTH_RADIUS_KM)
+                                                             / math.cos(math.radians(latitude)))))
+                self.west = (longitude - longitude_delta + 180.0) % 360.0 - 180.0
+                self.east = (longitude + longitude_delta + 180.0) % 360.0 - 180.0
+                if longitude_delta >= 180.0:
+                    self.west, self.east = -180.0, 180.0
+            default_label = f"{latitude:g}, {longitude:g}"
+        else:
+            raise ValueError(f"Invalid geographic target {code!r}, expected bbox:south,west,north,east[:label] with "
+                             f"south <= north or radius:latitude,longitude,km[:label], with latitudes from -90 "
+                             f"to 90 and longitudes from -180 to 180")
+        self.label = label.strip() or default_label
+        if self.radius_km is not None:
+            self.description = f"the area within {self.radius_km:g} km of {self.label}"
+        else:
+            self.description = label.strip() or f"the area from {default_label}"
+        # Directory name part, e.g. Radius_Paris or Bbox_47.5_1.5_49.5_3.5
+        slug_source = label.strip() or ("_".join(f"{n:g}" for n in numbers) + ("km" if self.radius_km else ""))
+        self.slug = f"{kind.capitalize()}_" + "".join(c if c.isalnum() or c in ".-" else "_" for c in slug_source)
+
+    def get_cells(self, cell_degrees):
+        rows = range(math.floor(self.south / cell_degrees), math.floor(self.north / cell_degrees) + 1)
+        west_col = math.floor(self.west / cell_degrees)
+        east_col = math.floor(self.east / cell_degrees)
+        if self.west <= self.east:
+            cols = list(range(west_col, east_col + 1))
+        else:
+            cols = list(range(west_col, math.floor(180.0 / cell_degrees) + 1)) + list(
+                range(math.floor(-180.0 / cell_degrees), east_col + 1))
+        return [(row, col) for row in rows for col in cols]
+
+    def contains(self, latitude, longitude):
+        if not self.south <= latitude <= self.north:
+            return False
+        if self.west <= self.east:
+            if not self.west <= longitude <= self.east:
+                return False
+        elif self.east < longitude < self.west:
+            return False
+        if self.center is None:
+            return True
+        # Haversine distance, only for the rows inside the bounding box of the circle
+        center_latitude, center_longitude = map(math.radians, self.center)
+        latitude, longitude = math.radians(latitude), math.radians(longitude)
+        a = (math.sin((latitude - center_latitude) / 2) ** 2 + math.cos(center_latitude) * math.cos(latitude)
+             * math.sin((longitude - center_longitude) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a))) <= self.radius_km
+
+
+@functools.lru_cache(maxsize=None)
+def get_geo_area(country_code):
+    # Geographic targets keep their whole code in the country code slot of a target
+    if country_code.startswith(("bbox:", "radius:")):
+        return GeoArea(country_code)
+    return None
+
+
+class _DescendingName:
+    # Inverts name ordering so the heap root is the alphabetically last name
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __lt__(self, other):
+        return other.name < self.name
+
+
+class TownTable:
+    """
+    Town records stored as columns: every name in one UTF-8 buffer with an offsets array, and populations and
+    geonameids in int64 arrays. Sorting and slicing return views that share the columns and only hold an
+    array of row indexes. Iterating yields (name, population, geonameid) tuples in the order of the view.
+    """
+
+    __slots__ = ("names", "offsets", "populations", "geonameids", "order")
+
+    def __init__(self):
+        self.names = bytearray()
+        self.offsets = array("q", [0])
+        self.populations = array("q")
+        self.geonameids = array("q")
+        self.order = None  # Row indexes of a sorted or sliced view, None for every row in insertion order
+
+    @classmethod
+    def from_records(cls, records):
+        table = cls()
+        for name, population, geonameid in records:
+            table.append(name, population, geonameid)
+        return table
+
+    def append(self, name, population, geonameid):
+        self.names += name.encode("utf-8")
+        self.offsets.append(len(self.names))
+        self.populations.append(population)
+        self.geonameids.append(geonameid)
+
+    def get_rows(self):
+        return self.order if self.order is not None else range(len(self.populations))
+
+    def view(self, order):
+        table = TownTable.__new__(TownTable)
+        table.names, table.offsets, table.populations, table.geonameids = (
+            self.names, self.offsets, self.populations, self.geonameids)
+        table.order = order if isinstance(order, array) else array("q", order)
+        return table
+
+    def __len__(self):
+        return len(self.get_rows())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.view(self.get_rows()[index])
+        row = self.get_rows()[index]
+        return self.get_name(row), self.populations[row], self.geonameids[row]
+
+    def __iter__(self):
+        names, offsets, populations, geonameids = self.names, self.offsets, self.populations, self.geonameids
+        for row in self.get_rows():
+            yield names[offsets[row]:offsets[row + 1]].decode("utf-8"), populations[row], geonameids[row]
+
+    def get_name(self, row):
+        return self.names[self.offsets[row]:self.offsets[row + 1]].decode("utf-8")
+
+    def get_populations(self):
+        if self.order is None:
+            return self.populations
+        return array("q", (self.populations[row] for row in self.order))
+
+    def sorted(self, by_population):
+        # Stable like list.sort. UTF-8 bytes sort in the same order as the names they encode.
+        if by_population:
+            return self.view(sorted(self.get_rows(), key=self.populations.__getitem__, reverse=True))
+        names, offsets = self.names, self.offsets
+        return self.view(sorted(self.get_rows(), key=lambda row: names[offsets[row]:offsets[row + 1]]))
+
+
+class TownSelector:
+    """
+    Streaming replacement for collecting every town and then sorting and truncating to max_towns.
+
+    Keeps a hash index of every name seen so the first occurrence of a name still wins, and a heap of
+    the best max_towns records for the sort order. records() returns exactly what sort_town_records
+    followed by [:max_towns] would have returned for the full list.
+    """
+
+    def __init__(self, max_towns, sort_by_population):
+        self.max_towns = max_towns
+        self.sort_by_population = sort_by_population
+        self.seen_names = set()
+        self.heap = []
+
+    def add(self, name, population, geonameid, country="", region=""):
+        if name in self.seen_names:
+            return
+        self.seen_names.add(name)
+        if self.max_towns <= 0:
+            return
+        # The heap root is always the worst kept record: lowest population (latest on ties, as the
+        # stable sort keeps earlier rows first) or the alphabetically last name
+        if self.sort_by_population:
+            entry = (population, -len(self.seen_names), name, geonameid)
+        else:
+            entry = (_DescendingName(name), population, geonameid)
+        if len(self.heap) < self.max_towns:
+            heapq.heappush(self.heap, entry)
+        elif self.heap[0] < entry:
+            heapq.heapreplace(self.heap, entry)
+
+    def records(self):
+        if self.sort_by_population:
+            return TownTable.from_records((name, population, geonameid)
+                                          for population, _, name, geonameid in sorted(self.heap, reverse=True))
+        return TownTable.from_records(sorted(((key.name, population, geonameid)
+                                              for key, population, geonameid in self.heap), key=lambda x: x[0]))
+
+
+class CollapsingTownSelector:
+    """
+    TownSelector for COLLAPSE_NEAR_DUPLICATES. Names that normalize to the same key, or with FUZZY_NEAR_DUPLICATES
+    to keys one edit apart, form a group that keeps its most populous name. The towns are selected from the
+    groups once every row has been added.
+
+    Fuzzy candidates come from a blocking index of every key and its single character deletions. Two keys one
+    edit or one swap apart always share an entry, so each name is only compared with the few keys in its buckets.
+    """
+
+    def __init__(self, max_towns, sort_by_population, selector_class=TownSelector):
+        self.max_towns = max_towns
+        self.sort_by_population = sort_by_population
+        self.selector_class = selector_class
+        self.groups = {}  # Normalized key to index in variants
+        self.variants = []  # (population, sequence, name, geonameid, country, region) kept for every group
+        self.blocks = {}  # Key or deletion of a key to the group keys indexed under it
+
+    def add(self, name, population, geonameid, country="", region=""):
+        key = normalize_town_name(name)
+        group = self.groups.get(key)
+        if group is None and FUZZY_NEAR_DUPLICATES and len(key) >= FUZZY_NAME_MIN_LENGTH:
+            group = self.find_similar_group(key)
+            if group is None:
+                for block in get_deletion_variants(key):
+                    self.blocks.setdefault(block, []).append(key)
+        if group is None:
+            self.groups[key] = len(self.variants)
+            self.variants.append((population, len(self.variants), name, geonameid, country, region))
+        else:
+            self.groups[key] = group
+            # Strictly more populous, so the first of equally populous variants is kept
+            if population > self.variants[group][0]:
+                self.variants[group] = (population, self.variants[group][1], name, geonameid, country, region)
+
+    def find_similar_group(self, key):
+        for block in get_deletion_variants(key):
+            for candidate in self.blocks.get(block, ()):
+                if is_one_edit_apart(key, candidate):
+                    return self.groups[candidate]
+        return None
+
+    def records(self):
+        # Groups keep the position of their first name, as exact duplicates do in TownSelector
+        selector = self.selector_class(self.max_towns, self.sort_by_population)
+        for population, _, name, geonameid, country, region in self.variants:
+            selector.add(name, population, geonameid, country, region)
+        return selector.records()
+
+
+class StratifiedTownSelector:
+    """
+    TownSelector for the world target with WORLD_QUOTAS. Every country gets a quota of max_towns from its
+    population in countryInfo.txt and keeps its best towns in a heap bounded by that quota. Towns pushed out of
+    or never let into a heap go to an overflow heap of max_towns towns, which fills the quotas of countries that
+    have fewer towns than they are entitled to.
+
+    With WORLD_QUOTA_STRATUM "admin1" the country quota is shared between its regions by the population of their
+    towns once every row has been added. Until then every region heap keeps WORLD_QUOTA_REGION_SLACK times the
+    share its towns so far entitle it to, so the heaps of a country hold at most (WORLD_QUOTA_REGION_SLACK + 1)
+    times its quota plus one town per region. The best towns that left them are kept up to the quota as well, and
+    fill the quota left over by regions with fewer towns than their share before the overflow heap does.
+    """
+
+    def __init__(self, max_towns, sort_by_population):
+        self.max_towns = max_towns
+        self.sort_by_population = sort_by_population
+        self.quotas = get_world_quotas(max_towns)
+        self.seen_names = set()
+        self.heaps = {}  # Country, or (country, region), to a heap of (population, -sequence, name, geonameid)
+        self.stratum_populations = {}  # Population of the towns added for every (country, region)
+        self.country_regions = {}  # Regions of every country, in the order they were first seen
+        self.country_weights = {}  # Sum of the quota weights of the regions of every country
+        self.country_sizes = {}  # Towns kept in the region heaps of every country
+        self.country_overflows = {}  # Best towns of every country that left its region heaps, up to its quota
+        self.overflow = []
+
+    def add(self, name, population, geonameid, country="", region=""):
+        if name in self.seen_names:
+            return
+        self.seen_names.add(name)
+        if self.max_towns <= 0:
+            return
+        entry = (population, -len(self.seen_names), name, geonameid)
+        quota = self.quotas.get(country, 0)
+        if quota and WORLD_QUOTA_STRATUM == "admin1":
+            self.add_to_region(entry, quota, country, region)
+            return
+        if quota:
+            heap = self.heaps.setdefault(country, [])
+            if len(heap) < quota:
+                heapq.heappush(heap, entry)
+                return
+            if heap[0] < entry:
+                entry = heapq.heapreplace(heap, entry)
+        self.add_overflow(entry)
+
+    def add_to_region(self, entry, quota, country, region):
+        stratum = (country, region)
+        if stratum not in self.heaps:
+            self.heaps[stratum] = []
+            self.stratum_populations[stratum] = 0
+            self.country_regions.setdefault(country, []).append(region)
+            self.country_sizes.setdefault(country, 0)
+        population = self.stratum_populations[stratum]
+        self.stratum_populations[stratum] = population + entry[0]
+        self.country_weights[country] = (self.country_weights.get(country, 0) - get_quota_weight(population)
+                                         + get_quota_weight(population + entry[0]))
+        heap = self.heaps[stratum]
+        if len(heap) < self.get_region_limit(quota, stratum):
+            heapq.heappush(heap, entry)
+            self.country_sizes[country] += 1
+        elif heap and heap[0] < entry:
+            self.add_country_overflow(quota, country, heapq.heapreplace(heap, entry))
+        else:
+            self.add_country_overflow(quota, country, entry)
+        regions = self.country_regions[country]
+        if self.country_sizes[country] > (WORLD_QUOTA_REGION_SLACK + 1) * quota + len(regions):
+            # Shares of regions that got no towns for a while have shrunk, trim their heaps to them
+            for region in regions:
+                heap = self.heaps[country, region]
+                limit = self.get_region_limit(quota, (country, region))
+                while len(heap) > limit:
+                    self.add_country_overflow(quota, country, heapq.heappop(heap))
+                    self.country_sizes[country] -= 1
+
+    def get_region_limit(self, quota, stratum):
+        weight = get_quota_weight(self.stratum_populations[stratum])
+        if weight <= 0:
+            return 0
+        return math.ceil(WORLD_QUOTA_REGION_SLACK * quota * weight / self.country_weights[stratum[0]])
+
+    def add_country_overflow(self, quota, country, entry):
+        heap = self.country_overflows.setdefault(country, [])
+        if len(heap) < quota:
+            heapq.heappush(heap, entry)
+        elif heap[0] < entry:
+            heapq.heapreplace(heap, entry)
+        self.add_overflow(entry)
+
+    def add_overflow(self, entry):
+        if len(self.overflow) < self.max_towns:
+            heapq.heappush(self.overflow, entry)
+        elif self.overflow[0] < entry:
+            heapq.heapreplace(self.overflow, entry)
+
+    def records(self):
+        selected = []
+        if WORLD_QUOTA_STRATUM == "admin1":
+            for country, regions in self.country_regions.items():
+                weights = {region: get_quota_weight(self.stratum_populations[country, region]) for region in regions}
+                region_quotas = allocate_quotas(weights, self.quotas[country])
+                remaining = []
+                country_selected = []
+                for region in regions:
+                    # Regions without a quota, such as regions of towns without a population, only fill the
+                    # quota other regions leave over
+                    heap = sorted(self.heaps[country, region], reverse=True)
+                    quota = region_quotas.get(region, 0)
+                    country_selected.extend(heap[:quota])
+                    remaining.extend(heap[quota:])
+                shortfall = self.quotas[country] - len(country_selected)
+                if shortfall > 0:
+                    country_selected.extend(heapq.nlargest(shortfall,
+                                                           remaining + self.country_overflows.get(country, [])))
+                selected.extend(country_selected)
+                chosen = {entry[1] for entry in country_selected}
+                for entry in remaining:
+                    if entry[1] not in chosen:
+                        self.add_overflow(entry)
+        else:
+            for heap in self.heaps.values():
+                selected.extend(heap)
+        # Towns of the country overflows are in the overflow heap as well
+        chosen = {entry[1] for entry in selected}
+        selected.extend(heapq.nlargest(self.max_towns - len(selected),
+                                       (entry for entry in self.overflow if entry[1] not in chosen)))
+        if self.sort_by_population:
+            return TownTable.from_records((name, population, geonameid)
+                                          for population, _, name, geonameid in sorted(selected, reverse=True))
+        return TownTable.from_records(sorted(((name, population, geonameid)
+                                              for population, _, name, geonameid in selected), key=lambda x: x[0]))
+
+
+def get_quota_weight(population):
+    return math.sqrt(population) if WORLD_QUOTAS == "sqrt" else population
+
+
+def allocate_quotas(weights, total, cap=None):
+    # Shares total between the keys in proportion to their weights, none getting more than cap, in whole
+    # numbers. Shares above the cap are handed to the others until no share is above it.
+    weights = {key: weight for key, weight in weights.items() if weight > 0}
+    shares = {}
+    remaining = total
+    while weights:
+        weight_sum = sum(weights.values())
+        capped = [key for key, weight in weights.items() if cap is not None and remaining * weight / weight_sum > cap]
+        if not capped:
+            shares.update((key, remaining * weight / weight_sum) for key, weight in weights.items())
+            break
+        for key in capped:
+            shares[key] = cap
+            remaining -= cap
+            del weights[key]
+    # Largest remainders get the towns left by rounding down, with ties in an order decided by the seed
+    quotas = {key: int(share) for key, share in shares.items()}
+    order = sorted(shares)
+    random.Random(WORLD_QUOTA_SEED).shuffle(order)
+    order.sort(key=lambda key: shares[key] - quotas[key], reverse=True)
+    for key in order[:round(sum(shares.values())) - sum(quotas.values())]:
+        quotas[key] += 1
+    return quotas
+
+
+def get_world_quotas(max_towns):
+    weights = {}
+    for country, columns in load_metadata_index(os.path.join(DATA_PATH, "countryInfo.txt"),
+                                                parse_geonames_codes).items():
+        if country.startswith("#") or len(columns) <= COLUMN_COUNTRY_POPULATION:
+            continue
+        try:
+            weights[country] = get_quota_weight(int(columns[COLUMN_COUNTRY_POPULATION]))
+        except ValueError:
+            continue
+    cap = WORLD_QUOTA_CAP * max_towns if WORLD_QUOTAS == "capped" else None
+    return allocate_quotas(weights, max_towns, cap)
+
+
+def create_town_selector(country_code=None):
+    selector_class = TownSelector
+    if country_code == "" and WORLD_QUOTAS:
+        selector_class = StratifiedTownSelector
+    if COLLAPSE_NEAR_DUPLICATES:
+        return CollapsingTownSelector(MAX_TOWNS, SORT_BY_POPULATION, selector_class)
+    return selector_class(MAX_TOWNS, SORT_BY_POPULATION)
+
+
+def normalize_town_name(name):
+    # "Saint-Étienne", "St. Etienne" and "SAINT ETIENNE" all become "saint etienne"
+    decomposed = unicodedata.normalize("NFKD", name)
+    folded = "".join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+    words = [TOWN_NAME_ABBREVIATIONS.get(word, word) for word in re.split(r"[\W_]+", folded) if word]
+    return " ".join(words) if words else folded
+
+
+def get_deletion_variants(key):
+    return [key] + [key[:i] + key[i + 1:] for i in range(len(key))]
+
+
+def is_one_edit_apart(a, b):
+    # True for one substituted, inserted or deleted character, two swapped neighbouring characters, or none
+    if len(a) > len(b):
+        a, b = b, a
+    if len(b) - len(a) > 1:
+        return False
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:] or a[i + 1:i + 2] + a[i:i + 1] + a[i + 2:] == b[i:]
+    return a[i:] == b[i + 1:]
+
+
+def clean_town_name(raw_name):
+    return raw_name.replace("'", "’").strip().replace('"', "'")
+
+
+def compile_town_filters(targets):
+    # Routing table keyed by country code so each row is only tested against the targets that can match it.
+    # World targets (empty country code) are stored under "" and see every row.
+    routing_table = {}
+    for target_index, (country_code, region_codes, subregion_code) in enumerate(targets):
+        routing_table.setdefault(country_code, []).append(
+            (target_index, set(normalize_region_codes(region_codes)), subregion_code))
+    return routing_table
+
+
+def get_zip_member_name(file_path):
+    return os.path.splitext(os.path.basename(file_path))[0] + ".txt"
+
 
-    towns = []
-    with open(file_path, "r", encoding="utf-8") as f:
+def open_data_file(file_path, binary=False):
+    # Data files are either extracted text files or GeoNames zips holding a text file of the same name
+    if not file_path.endswith(".zip"):
+        return open(file_path, "rb") if binary else open(file_path, "r", encoding="utf-8")
+    with zipfile.ZipFile(file_path) as archive:
+        # The archive file stays open until the member stream is closed
+        stream = archive.open(get_zip_member_name(file_path))
+    return stream if binary else io.TextIOWrapper(stream, encoding="utf-8")
+
+
+def iter_town_rows(file_path, countries=None):
+    # Yields (country, region, subregion, feature code, population, raw name, geonameid) for every populated place,
+    # optionally only for the given countries. Rows are rejected on their raw bytes before anything is decoded.
+    count_build_stat("bytes_read", os.path.getsize(file_path))
+    feature_type = COLUMN_FEATURE_TYPE.encode()
+    country_codes = {country.encode() for country in countries} if countries is not None else None
+    prefix_columns = max(COLUMN_FEATURE_TYPE_LOC, COLUMN_COUNTRY) + 1
+    rows_scanned = 0
+    with open_data_file(file_path, binary=True) as f:
         for line in f:
-            columns = line.split("\t")
+            rows_scanned += 1
+            columns = line.split(b"\t", prefix_columns)
+            if columns[COLUMN_FEATURE_TYPE_LOC] != feature_type:
+                continue
+            if country_codes is not None and columns[COLUMN_COUNTRY] not in country_codes:
+                continue
+            columns = line.split(b"\t")
+            yield (columns[COLUMN_COUNTRY].decode(), columns[COLUMN_REGION].decode(),
+                   columns[COLUMN_SUBREGION].decode(), columns[COLUMN_TYPE_SUB_TYPE_LOC].decode(),
+                   columns[COLUMN_POPULATION].decode(), columns[COLUMN_NAME].decode("utf-8"),
+                   columns[COLUMN_GEONAMEID].decode())
+    count_build_stat("rows_scanned", rows_scanned)
+
+
+def get_target_partitions(targets):
+    # Returns None when a world target needs every partition, otherwise {country: set of admin1 codes or None}
+    partitions = {}
+    for country_code, region_codes, _ in targets:
+        if not country_code:
+            return None
+        region_codes = normalize_region_codes(region_codes)
+        if not region_codes:
+            partitions[country_code] = None
+        elif partitions.get(country_code, set()) is not None:
+            partitions.setdefault(country_code, set()).update(region_codes)
+    return partitions
+
+
+@timed_stage
+def read_and_process_towns_for_targets(file_path, targets):
+    routing_table = compile_town_filters(targets)
+    world_routes = routing_table.get("", [])
+    selectors = [create_town_selector(country_code) for country_code, _, _ in targets]
+    manifest = load_town_cache_manifest(file_path) if USE_TOWN_CACHE else None
+    if manifest is not None:
+        rows = iter_cached_town_rows(file_path, manifest, get_target_partitions(targets))
+    else:
+        # Without a world target, rows of other countries never need to be decoded
+        rows = iter_town_rows(file_path, None if world_routes else routing_table)
+    for country, region, subregion, feature_code, population, raw_name, geonameid in rows:
+        if COLUMN_TYPE_SUB_TYPE and feature_code not in COLUMN_TYPE_SUB_TYPE:
+            continue
+        routes = routing_table.get(country, [])
+        if world_routes and country != "":
+            routes = routes + world_routes
+        name = None
+        for target_index, region_codes, subregion_code in routes:
             # If we have multiple regions, check if the town's region is in our list
-            region_match = (not region_codes or
-                          columns[COLUMN_REGION] in region_codes)
-
-            if ((country_code and columns[COLUMN_COUNTRY] != country_code)
-                    or not region_match
-                    or (subregion_code
-                        and columns[COLUMN_SUBREGION] != subregion_code) or
-                (columns[COLUMN_FEATURE_TYPE_LOC] != COLUMN_FEATURE_TYPE) or
-                (COLUMN_TYPE_SUB_TYPE and columns[COLUMN_TYPE_SUB_TYPE_LOC]
-                 not in COLUMN_TYPE_SUB_TYPE) or
-                (int(columns[COLUMN_POPULATION]) < POPULATION_THRESHOLD)):
+            if ((region_codes and region not in region_codes)
+                    or (subregion_code and subregion != subregion_code) or
+                    (int(population) < POPULATION_THRESHOLD)):
                 continue
-            name = columns[COLUMN_NAME].replace("'", "’").strip().replace('"', "'")
-            if any(town[0] == name for town in towns):
+            if name is None:
+                name = clean_town_name(raw_name)
+                population = int(population)
+                geonameid = int(geonameid)
+            selectors[target_index].add(name, population, geonameid, country, region)
+    return [selector.records() for selector in selectors]
+
+
+@timed_stage
+def read_towns_in_area(file_path, area):
+    # Area targets are always answered from the town cache and its spatial index
+    manifest = ensure_town_cache(file_path)
+    selector = create_town_selector()
+    for _, _, _, feature_code, population, raw_name, geonameid in iter_cached_town_rows(file_path, manifest,
+                                                                                         area=area):
+        if COLUMN_TYPE_SUB_TYPE and feature_code not in COLUMN_TYPE_SUB_TYPE:
+            continue
+        if int(population) < POPULATION_THRESHOLD:
+            continue
+        selector.add(clean_town_name(raw_name), int(population), geonameid)
+    return selector.records()
+
+
+def read_and_process_towns(file_path, country_code, region_codes, subregion_code):
+    return read_and_process_towns_for_targets(
+        file_path, [(country_code, region_codes, subregion_code)])[0]
+
+
+def read_towns_for_targets(targets, errors=None):
+    # Group targets by the data file they read so every file is scanned only once. With an errors dict, a file
+    # that cannot be read records the error for each of its targets by index instead of stopping the others.
+    targets_by_file = {}
+    target_records = [None] * len(targets)
+    for target_index, (country_code, _, _) in enumerate(targets):
+        if is_target_up_to_date(targets[target_index]):
+            # Left to be skipped when it is built, without reading its data file
+            continue
+        try:
+            input_data = determine_input_data(country_code)
+        except Exception as e:
+            print(e)
+            continue
+        area = get_geo_area(country_code)
+        if area is None:
+            targets_by_file.setdefault(input_data, []).append(target_index)
+            continue
+        # Area targets do not scan, they read a few cache partitions through the spatial index
+        try:
+            target_records[target_index] = read_towns_in_area(input_data, area)
+        except Exception as e:
+            if errors is None:
+                raise
+            print(f"Failed to read {input_data}: {e}")
+            errors[target_index] = f"Failed to read {input_data}: {e}"
+
+    for input_data, target_indexes in targets_by_file.items():
+        if VERBOSE_OUTPUT:
+            print(f"Scanning {input_data} for {len(target_indexes)} targets")
+        try:
+            file_records = read_and_process_towns_for_targets(input_data, [targets[i] for i in target_indexes])
+        except Exception as e:
+            if errors is None:
+                raise
+            print(f"Failed to read {input_data}: {e}")
+            for target_index in target_indexes:
+                errors[target_index] = f"Failed to read {input_data}: {e}"
+            continue
+        for target_index, town_records in zip(target_indexes, file_records):
+            target_records[target_index] = town_records
+    return target_records
+
+
+def get_town_cache_dir(file_path):
+    return os.path.join(CACHE_PATH, os.path.splitext(os.path.basename(file_path))[0])
+
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_town_cache_manifest(file_path):
+    # Returns the cache manifest if the cache still matches the source file, otherwise None
+    manifest_path = os.path.join(get_town_cache_dir(file_path), TOWN_CACHE_MANIFEST)
+    if not os.path.exists(manifest_path) or not os.path.exists(file_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != TOWN_CACHE_VERSION:
+        return None
+    stat = os.stat(file_path)
+    if manifest["source_size"] != stat.st_size:
+        return None
+    if manifest["source_mtime_ns"] != stat.st_mtime_ns:
+        # Same size but touched: only keep the cache if the contents are really unchanged
+        if hash_file(file_path) != manifest["source_sha256"]:
+            return None
+        manifest["source_mtime_ns"] = stat.st_mtime_ns
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+    return manifest
+
+
+def flush_town_cache_partitions(cache_dir, partition_buffers, partition_files):
+    for key, columns in partition_buffers.items():
+        if key not in partition_files:
+            partition_files[key] = f"p{len(partition_files):05}.pkl"
+        # Partitions are a sequence of pickled column chunks appended in file order
+        with open(os.path.join(cache_dir, partition_files[key]), "ab") as f:
+            pickle.dump(columns, f, protocol=pickle.HIGHEST_PROTOCOL)
+    partition_buffers.clear()
+
+
+def build_town_cache(file_path):
+    cache_dir = get_town_cache_dir(file_path)
+    temp_dir = cache_dir + ".tmp"
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+    print(f"Building town cache for {file_path}")
+
+    stat = os.stat(file_path)
+    # Text sources are hashed while they are read; zips are hashed as they are on disk
+    digest = hashlib.sha256() if not file_path.endswith(".zip") else None
+    partition_buffers = {}
+    partition_files = {}
+    partition_rows = {}
+    partition_cells = {}
+    buffered_rows = 0
+    feature_type = COLUMN_FEATURE_TYPE.encode()
+    with open_data_file(file_path, binary=True) as f:
+        for line_number, raw_line in enumerate(f):
+            if digest is not None:
+                digest.update(raw_line)
+            if raw_line.split(b"\t", COLUMN_FEATURE_TYPE_LOC + 1)[COLUMN_FEATURE_TYPE_LOC] != feature_type:
+                continue
+            columns = raw_line.decode("utf-8").split("\t")
+            key = (columns[COLUMN_COUNTRY], columns[COLUMN_REGION])
+            if key not in partition_buffers:
+                # line numbers, names, subregions, feature codes, populations, latitudes, longitudes, geonameids
+                partition_buffers[key] = (array("q"), [], [], [], array("q"), array("d"), array("d"), array("q"))
+            line_numbers, names, subregions, feature_codes, populations, latitudes, longitudes, geonameids = \
+                partition_buffers[key]
+            line_numbers.append(line_number)
+            geonameids.append(int(columns[COLUMN_GEONAMEID]))
+            names.append(columns[COLUMN_NAME])
+            subregions.append(columns[COLUMN_SUBREGION])
+            feature_codes.append(columns[COLUMN_TYPE_SUB_TYPE_LOC])
+            populations.append(int(columns[COLUMN_POPULATION]))
+            latitude, longitude = float(columns[COLUMN_LATITUDE]), float(columns[COLUMN_LONGITUDE])
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+            partition_cells.setdefault(key, set()).add(
+                (math.floor(latitude / SPATIAL_GRID_DEGREES), math.floor(longitude / SPATIAL_GRID_DEGREES)))
+            partition_rows[key] = partition_rows.get(key, 0) + 1
+            buffered_rows += 1
+            if buffered_rows >= TOWN_CACHE_FLUSH_ROWS:
+                flush_town_cache_partitions(temp_dir, partition_buffers, partition_files)
+                buffered_rows = 0
+    flush_town_cache_partitions(temp_dir, partition_buffers, partition_files)
+
+    # Grid cells point to the partitions that have towns in them, so area targets only read those partitions
+    spatial_index = {"cell_degrees": SPATIAL_GRID_DEGREES, "cells": {}}
+    for key, cells in partition_cells.items():
+        for cell in cells:
+            spatial_index["cells"].setdefault(cell, []).append(partition_files[key])
+    with open(os.path.join(temp_dir, SPATIAL_INDEX_FILE), "wb") as f:
+        pickle.dump(spatial_index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # The manifest is written last so an interrupted ingest never looks valid
+    manifest = {
+        "version": TOWN_CACHE_VERSION,
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "source_sha256": digest.hexdigest() if digest is not None else hash_file(file_path),
+        "partitions": [[country, region, partition_files[(country, region)], partition_rows[(country, region)]]
+                       for country, region in sorted(partition_files)],
+    }
+    with open(os.path.join(temp_dir, TOWN_CACHE_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(temp_dir, cache_dir)
+    if VERBOSE_OUTPUT:
+        print(f"Cached {sum(partition_rows.values())} towns in {len(partition_files)} partitions")
+    return manifest
+
+
+def ensure_town_cache(file_path):
+    manifest = load_town_cache_manifest(file_path)
+    if manifest is None:
+        # Parallel builds of the same cache would share its temporary directory, so one process builds it
+        # and the others wait and then read the cache it built
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        with FileLock(get_town_cache_dir(file_path) + ".lock", TOWN_CACHE_LOCK_TIMEOUT):
+            manifest = load_town_cache_manifest(file_path)
+            if manifest is None:
+                manifest = build_town_cache(file_path)
+    return manifest
+
+
+def load_town_cache_chunks(partition_path):
+    # The partition is reopened for every chunk, so merging thousands of partitions never holds their files open
+    count_build_stat("bytes_read", os.path.getsize(partition_path))
+    offset = 0
+    while True:
+        with open(partition_path, "rb") as f:
+            f.seek(offset)
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            offset = f.tell()
+        yield chunk
+
+
+_RESIDENT_PARTITIONS = None  # Partition path to (source hash, chunks) while the build server runs
+
+
+def get_town_cache_chunks(partition_path, source_sha256):
+    # The build server keeps every partition it has read in memory until its source file changes
+    if _RESIDENT_PARTITIONS is None:
+        return load_town_cache_chunks(partition_path)
+    resident = _RESIDENT_PARTITIONS.get(partition_path)
+    if resident is None or resident[0] != source_sha256:
+        resident = _RESIDENT_PARTITIONS[partition_path] = (source_sha256,
+                                                           list(load_town_cache_chunks(partition_path)))
+    return resident[1]
+
+
+def read_town_cache_partition(chunks, country, region, area=None):
+    for line_numbers, names, subregions, feature_codes, populations, latitudes, longitudes, geonameids in chunks:
+        count_build_stat("rows_scanned", len(line_numbers))
+        for line_number, name, subregion, feature_code, population, latitude, longitude, geonameid in zip(
+                line_numbers, names, subregions, feature_codes, populations, latitudes, longitudes, geonameids):
+            if area is not None and not area.contains(latitude, longitude):
                 continue
-            population = int(columns[COLUMN_POPULATION])
-            weight = math.floor(math.sqrt(math.sqrt(population)))
-            towns.append((name, population, weight))
-    return towns
+            yield line_number, country, region, subregion, feature_code, population, name, geonameid
+
+
+def get_area_partition_files(file_path, area):
+    with open(os.path.join(get_town_cache_dir(file_path), SPATIAL_INDEX_FILE), "rb") as f:
+        spatial_index = pickle.load(f)
+    partition_files = set()
+    for cell in area.get_cells(spatial_index["cell_degrees"]):
+        partition_files.update(spatial_index["cells"].get(cell, ()))
+    return partition_files
+
+
+def iter_cached_town_rows(file_path, manifest, partitions=None, area=None):
+    # Same rows as iter_town_rows, read only from the partitions needed and merged back into file order.
+    # With an area, only partitions with towns in its grid cells are read, and only rows inside it are kept.
+    cache_dir = get_town_cache_dir(file_path)
+    area_partition_files = get_area_partition_files(file_path, area) if area is not None else None
+    partition_readers = []
+    for country, region, partition_file, _ in manifest["partitions"]:
+        if partitions is not None:
+            if country not in partitions:
+                continue
+            if partitions[country] is not None and region not in partitions[country]:
+                continue
+        if area_partition_files is not None and partition_file not in area_partition_files:
+            continue
+        chunks = get_town_cache_chunks(os.path.join(cache_dir, partition_file), manifest["source_sha256"])
+        partition_readers.append(read_town_cache_partition(chunks, country, region, area))
+    for _, country, region, subregion, feature_code, population, name, geonameid in heapq.merge(*partition_readers):
+        yield country, region, subregion, feature_code, population, name, geonameid
 
 
+@timed_stage
 def sort_town_records(town_records, sort_by_population):
-    if sort_by_population:
-        town_records.sort(key=lambda x: x[1], reverse=True)
-    else:
-        town_records.sort(key=lambda x: x[0])
-    return town_records
+    # Returns a sorted view of the TownTable
+    return town_records.sorted(sort_by_population)
 
 
-def calculate_town_weights(town_records):
-    max_weight = max((w for _, _, w in town_records), default=0)
-    min_weight = min((w for _, _, w in town_records), default=0)
+def parse_weight_curve(value):
+    if value in WEIGHT_CURVES:
+        return value
+    try:
+        exponent = float(value)
+    except ValueError:
+        exponent = None
+    # Exponents of 0 or below give every town the same chance or divide by the towns without a population
+    if exponent is None or not math.isfinite(exponent) or exponent <= 0:
+        raise argparse.ArgumentTypeError(
+            f"expected one of {', '.join(WEIGHT_CURVES)} or an exponent above 0, got {value!r}")
+    return exponent
+
+
+@functools.lru_cache(maxsize=None)
+def get_numpy():
+    # Imported on first use, as it takes longer to import than the rest of this script. None when not installed.
+    try:
+        import numpy
+    except ImportError:
+        return None  # Town weights are then scored in plain Python
+    return numpy
+
+
+def apply_weight_curve(populations, curve):
+    # Raw weights for a sequence of populations, as a NumPy array when NumPy is available
+    np = get_numpy()
+    if np is not None:
+        populations = np.asarray(populations, dtype=np.float64)
+        if curve == "fourth_root":
+            return np.floor(np.sqrt(np.sqrt(populations)))
+        if curve == "log":
+            return np.log1p(populations)
+        if curve == "rank":
+            # Equal populations share a rank, so they keep the same chance
+            return np.unique(populations, return_inverse=True)[1] + 1.0
+        return populations ** float(curve)
+    if curve == "fourth_root":
+        return [math.floor(math.sqrt(math.sqrt(population))) for population in populations]
+    if curve == "log":
+        return [math.log1p(population) for population in populations]
+    if curve == "rank":
+        ranks = {population: rank for rank, population in enumerate(sorted(set(populations)), start=1)}
+        return [ranks[population] for population in populations]
+    return [population ** float(curve) for population in populations]
+
+
+@timed_stage
+def score_town_records(town_records, curve):
+    """
+    Scores the selected towns in one batch. Returns the weights written to the NewGRF, scaled to 1-127
+    between the lowest and highest raw weight, and the lowest population summary for the description.
+    """
+    populations = town_records.get_populations()
+    if not populations:
+        return array("B"), ""
+    raw_weights = apply_weight_curve(populations, curve)
+    np = get_numpy()
+    if np is not None:
+        min_weight, max_weight = raw_weights.min(), raw_weights.max()
+    else:
+        min_weight, max_weight = min(raw_weights), max(raw_weights)
     scale = 127 / (max_weight - min_weight) if max_weight != min_weight else 0
-    return min_weight, scale
+    if np is not None:
+        weights = array("B", np.clip(((raw_weights - min_weight) * scale).astype(np.int64), 1, 127)
+                        .astype(np.uint8).tobytes())
+    else:
+        weights = array("B", [max(1, min(int((weight - min_weight) * scale), 127)) for weight in raw_weights])
 
+    # Round the population of the last town to 3 significant figures for readability, if it is worth showing
+    if populations[-1] < 100:
+        lowest_population = ""
+    else:
+        lowest_population = "{:,}".format(int(to_precision(populations[-1], 3)))
+        lowest_population = f" that have a population of {lowest_population} and higher"
+    return weights, lowest_population
 
-def write_nml_file(output_nml, grf_id, version, town_records, min_weight, scale):
+
+@timed_stage
+def write_nml_file(output_nml, grf_id, version, town_records, weights):
     with open(output_nml, "w+", encoding="utf-8") as f_out:
         f_out.write(NML_BOILERPLATE.format(grf_id=grf_id, version=version))
-        for name, _, weight in town_records:
-            scaled_weight = max(1, min(int((weight - min_weight) * scale), 127))
-            full_name = f'\ttext("{name}", {scaled_weight}),\n'
+        for (name, _, _), weight in zip(town_records, weights):
+            full_name = f'\ttext("{name}", {weight}),\n'
             f_out.write(full_name)
         f_out.write("}\n}\n")
 
 
-def determine_input_data(country_code):
-    # Check if merged file should be used
-    if MERGED_FILE_OVERRIDE or country_code == "":
-        if not os.path.exists(os.path.join(DATA_PATH, "allCountries.txt")):
-            download_data_files("allCountries.zip", DATA_URL + "allCountries.zip")
-        file_path = os.path.join(DATA_PATH, "allCountries.txt")
+# Native GRF backend. Produces the same bytes as nmlc for the NML and lang files this script writes.
+
+
+def is_grf_ascii_string(value):
+    # nmlc writes a string as plain bytes only if it has no characters from "{" upwards and no \U escapes
+    i = 0
+    while i < len(value):
+        if value[i] != "\\":
+            if ord(value[i]) >= 0x7B:
+                return False
+            i += 1
+        elif value[i + 1] in ("\\", '"'):
+            i += 2
+        elif value[i + 1] == "U":
+            return False
+        else:
+            i += 3
+    return True
+
+
+def encode_grf_string(value, final_zero=True):
+    # value uses NML string escapes: \\, \", \XX for a byte and \UXXXX for a unicode character
+    data = bytearray()
+    if not is_grf_ascii_string(value):
+        data += GRF_STRING_UNICODE_PREFIX
+    if "\\" not in value:
+        data += value.encode("utf-8")
     else:
-        file_path = os.path.join(DATA_PATH, f"Data/{country_code}.txt")
+        i = 0
+        while i < len(value):
+            if value[i] != "\\":
+                data += value[i].encode("utf-8")
+                i += 1
+            elif value[i + 1] in ("\\", '"'):
+                data.append(ord(value[i + 1]))
+                i += 2
+            elif value[i + 1] == "U":
+                data += chr(int(value[i + 2:i + 6], 16)).encode("utf-8")
+                i += 6
+            else:
+                data.append(int(value[i + 1:i + 3], 16))
+                i += 3
+    if final_zero:
+        data.append(0)
+    return bytes(data)
+
+
+def read_lang_strings(lang_file_path):
+    strings = {}
+    with open(lang_file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n\r").lstrip("\ufeff")
+            if not line or line.startswith("#"):
+                continue
+            name, value = line.split(":", maxsplit=1)
+            strings[name.rstrip()] = value
+    return strings
+
 
-    if not os.path.exists(os.path.join(DATA_PATH, "Data")):
-        os.makedirs(os.path.join(DATA_PATH, "Data"), exist_ok=True)
-    if not os.path.exists(file_path):
-        download_and_extract_country_file(country_code, file_path)
+def resolve_lang_string(value):
+    # Replaces {COMMAND}s with their escapes, choosing unicode or ascii codes for the whole string like nmlc
+    components = []
+    i = 0
+    while i < len(value):
+        start = value.find("{", i)
+        if start == -1:
+            components.append(value[i:])
+            break
+        components.append(value[i:start])
+        end = value.find("}", start)
+        command = value[start + 1:end] if end != -1 else None
+        if command not in GRF_STRING_COMMANDS:
+            raise ValueError(f"String command {{{command}}} is not supported by the native backend, use nmlc")
+        components.append(GRF_STRING_COMMANDS[command])
+        i = end + 1
+    unicode = any(component[1] is None if isinstance(component, tuple) else not is_grf_ascii_string(component)
+                  for component in components)
+    return "".join(component[0 if unicode else 1] if isinstance(component, tuple) else component
+                   for component in components)
+
+
+def grf_pseudo_sprite(data):
+    return struct.pack("<IB", len(data), 0xFF) + data
+
+
+def build_action14_info(url, version, min_compatible_version=1):
+    data = bytearray(b"\x14CINFO")
+    data += b"TURL_" + bytes([GRF_DEFAULT_LANGUAGE]) + encode_grf_string(url)
+    data += b"BVRSN" + struct.pack("<HI", 4, version)
+    data += b"BMINV" + struct.pack("<HI", 4, min_compatible_version)
+    data += b"BNPAR" + struct.pack("<HB", 1, 0)
+    data += b"BPALS" + struct.pack("<H", 1) + b"A"
+    data += b"BBLTR" + struct.pack("<H", 1) + b"8"
+    data += b"\x00\x00"  # end of INFO, end of action 14
+    return bytes(data)
+
+
+def build_action8(grf_id, name, description):
+    return b"\x08\x08" + encode_grf_string(grf_id, final_zero=False) + encode_grf_string(name) + encode_grf_string(
+        description)
+
+
+def build_action_f(id_number, style_name, pieces, startbit, num_bits):
+    # pieces are (text, probability) or (None, (probability, referenced id number))
+    data = bytearray(b"\x0f")
+    if style_name is not None:
+        data.append(id_number | 0x80)
+        data.append(GRF_DEFAULT_LANGUAGE)
+        data += encode_grf_string(style_name)
+        data.append(0)
+    else:
+        data.append(id_number)
+    data += bytes([1, len(pieces), startbit, num_bits])
+    for text, probability in pieces:
+        if text is None:
+            data += bytes([probability[0] | 0x80, probability[1]])
+        else:
+            data.append(probability)
+            data += encode_grf_string(text)
+    return bytes(data)
+
+
+def get_town_names_bits(total):
+    num_bits = 1
+    while total > (1 << num_bits):
+        num_bits += 1
+    return num_bits
+
+
+def build_town_names_actions(style_name, town_names):
+    # town_names are (text, probability). A part holds at most 255 texts, so bigger sets are spread over
+    # sub town_names blocks referenced from the final one, exactly the way nmlc splits them.
+    if len(town_names) <= 255:
+        total = sum(probability for _, probability in town_names)
+        return [build_action_f(0, style_name, town_names, 0, get_town_names_bits(total))]
+
+    number_action_f = (len(town_names) + 254) // 255
+    pow2 = 1
+    while pow2 < number_action_f:
+        pow2 = pow2 * 2
+    if pow2 < 255:
+        number_action_f = pow2
+    heap = [(0, i, []) for i in range(number_action_f)]
+    heapq.heapify(heap)
+    finished = []
+    for probability, _, text in sorted(((probability, idx, text) for idx, (text, probability) in enumerate(town_names)),
+                                       reverse=True):
+        while True:
+            sub = heapq.heappop(heap)
+            if len(sub[2]) < 255:
+                break
+            finished.append(sub)
+        sub[2].append((text, probability))
+        heapq.heappush(heap, (sub[0] + probability, sub[1], sub[2]))
+    finished.extend(heap)
+
+    # All sub blocks use the same number of bits so no name gets a higher chance than intended
+    max_probability = max(sub[0] for sub in finished)
+    sub_bits = 1
+    while (1 << sub_bits) < max_probability:
+        sub_bits += 1
+    actions = [build_action_f(id_number, None, pieces, 0, sub_bits)
+               for id_number, (_, _, pieces) in enumerate(finished)]
+    # Sub blocks with a single piece do not consume random bits
+    startbit = sub_bits if any(len(pieces) > 1 for _, _, pieces in finished) else 0
+    references = [(None, (1, id_number)) for id_number in range(len(finished))]
+    actions.append(build_action_f(len(finished), style_name, references, startbit,
+                                  get_town_names_bits(len(references))))
+    return actions
+
+
+def build_town_names_grf(grf_id, version, town_names, lang_file_path):
+    strings = {name: resolve_lang_string(value) for name, value in read_lang_strings(lang_file_path).items()}
+    sprites = [
+        build_action14_info(strings["STR_GRF_URL"], version),
+        build_action8(grf_id, strings["STR_GRF_NAME"], strings["STR_GRF_DESC"]),
+    ]
+    sprites.extend(build_town_names_actions(strings["STR_GAME_OPTIONS_TOWN_NAME"], town_names))
+    data = grf_pseudo_sprite(struct.pack("<I", len(sprites)))
+    data += b"".join(grf_pseudo_sprite(sprite) for sprite in sprites)
+    data += b"\x00\x00\x00\x00"  # end of data section
+    # Container version 2: header, data section offset, no compression, data, empty sprite section
+    return GRF_CONTAINER_HEADER + struct.pack("<IB", len(data) + 1, 0) + data + b"\x00\x00\x00\x00"
+
+
+@timed_stage
+def write_grf_file(output_grf, grf_id, version, town_records, weights, lang_file_path):
+    town_names = [(name, weight) for (name, _, _), weight in zip(town_records, weights)]
+    grf_data = build_town_names_grf(grf_id, version, town_names, lang_file_path)
+    with open(output_grf + ".tmp", "wb") as f:
+        f.write(grf_data)
+    os.replace(output_grf + ".tmp", output_grf)
+
+
+def find_data_file(file_path):
+    # Returns the extracted text file, or its zip when zips are read directly, or None if neither exists
+    if os.path.exists(file_path):
+        return file_path
+    zip_path = os.path.splitext(file_path)[0] + ".zip"
+    if STREAM_FROM_ZIP and os.path.exists(zip_path):
+        return zip_path
+    return None
+
+
+def get_data_file_name(country_code):
+    # Name of the zip holding the rows of a country, relative to DATA_PATH
+    if MERGED_FILE_OVERRIDE or country_code == "" or get_geo_area(country_code) is not None:
+        return "allCountries.zip"
+    return f"Data/{country_code}.zip"
+
+
+@timed_stage
+def determine_input_data(country_code):
+    data_file_name = get_data_file_name(country_code)
+    file_path = find_data_file(os.path.join(DATA_PATH, data_file_name.replace(".zip", ".txt")))
+    if file_path is None:
+        if data_file_name == "allCountries.zip":
+            download_data_files(data_file_name, DATA_URL + data_file_name)
+            file_path = find_data_file(os.path.join(DATA_PATH, "allCountries.txt"))
+        else:
+            file_path = download_and_extract_country_file(
+                country_code, os.path.join(DATA_PATH, f"Data/{country_code}.txt"))
+    if USE_TOWN_CACHE or get_geo_area(country_code) is not None:
+        ensure_town_cache(file_path)
     return file_path
 
 
-def download_and_extract_country_file(country_code, file_path):
-    zip_file = f"{country_code}.zip"
-    zip_path = os.path.join(DATA_PATH, f"Data/{zip_file}")
-    print(zip_path)
+def read_download_state():
+    try:
+        with open(os.path.join(DATA_PATH, DOWNLOAD_STATE_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+_DOWNLOAD_STATE_LOCK = threading.Lock()  # Held while download_state.json is updated
+
 
-    # URL to download the file
-    download_url = DATA_URL + zip_file
+def write_download_state(state):
+    state_path = os.path.join(DATA_PATH, DOWNLOAD_STATE_FILE)
+    temp_path = state_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(temp_path, state_path)
 
-    # Download the zip file
-    print(f"Downloading {download_url}")
-    subprocess.run(["curl", "-o", zip_path, download_url], check=True)
 
-    # Extract the zip file
-    print(f"Extracting {zip_path}")
-    subprocess.run(["tar", "-xf", zip_path, "-C", f"{DATA_PATH}/Data"], check=True)
+def download_file(url, file_path, validators=None):
+    # Returns the state entry of the new file, or None if the server reports the known copy as unchanged
+    part_path = file_path + ".part"
+    part_info_path = part_path + ".json"
+    headers = {"User-Agent": "Taby_Town_Names"}
+    if validators is not None:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    # A partial file is only resumed if the server can tell whether it still has the same version
+    try:
+        with open(part_info_path, "r", encoding="utf-8") as f:
+            part_info = json.load(f)
+        offset = os.path.getsize(part_path)
+    except (OSError, ValueError):
+        part_info, offset = {}, 0
+    resume_validator = part_info.get("etag") or part_info.get("last_modified")
+    if offset and resume_validator:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = resume_validator
+
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None
+        if e.code == 416:
+            # The partial file does not fit the current version, start over on the next attempt
+            os.remove(part_path)
+        raise
+    with response:
+        if response.status == 206:
+            content_range = response.headers.get("Content-Range", "")
+            if not content_range.startswith(f"bytes {offset}-"):
+                os.remove(part_path)
+                raise OSError(f"Unexpected Content-Range {content_range!r} for {url}")
+            total_size = content_range.rpartition("/")[2]
+            mode = "ab"
+        else:
+            part_info = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            with open(part_info_path, "w", encoding="utf-8") as f:
+                json.dump(part_info, f)
+            total_size = response.headers.get("Content-Length")
+            mode = "wb"
+        with open(part_path, mode) as f:
+            shutil.copyfileobj(response, f, DOWNLOAD_CHUNK_SIZE)
+
+    size = os.path.getsize(part_path)
+    if total_size not in (None, "*") and size != int(total_size):
+        raise OSError(f"Incomplete download of {url}: {size} of {total_size} bytes")
+    if file_path.endswith(".zip"):
+        try:
+            with zipfile.ZipFile(part_path) as archive:
+                bad_member = archive.testzip()
+        except zipfile.BadZipFile:
+            bad_member = part_path
+        if bad_member is not None:
+            os.remove(part_path)
+            raise OSError(f"Corrupt download of {url}: checksum mismatch in {bad_member}")
+    entry = {
+        "etag": part_info.get("etag"),
+        "last_modified": part_info.get("last_modified"),
+        "size": size,
+        "sha256": hash_file(part_path),
+    }
+    os.replace(part_path, file_path)
+    os.remove(part_info_path)
+    return entry
+
+
+def fetch_file(url, file_path, validators=None):
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            return download_file(url, file_path, validators)
+        except OSError as e:
+            # Client errors such as 404 will not go away by asking again
+            if attempt == DOWNLOAD_RETRIES or (isinstance(e, urllib.error.HTTPError) and e.code < 500):
+                raise
+            print(f"Retrying {url} ({e})")
+
+
+def download_files(downloads):
+    # Downloads (url, file path, conditional) entries concurrently, extracts zips when they are not read
+    # directly, and returns the paths that were written
+    state = read_download_state()
+    written = []
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, DOWNLOAD_JOBS)) as executor:
+        futures = {}
+        for url, file_path, conditional in downloads:
+            print(f"Downloading {url}")
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            validators = state.get(url) if conditional else None
+            futures[executor.submit(fetch_file, url, file_path, validators)] = (url, file_path)
+        for future in concurrent.futures.as_completed(futures):
+            url, file_path = futures[future]
+            try:
+                entry = future.result()
+            except OSError as e:
+                failures.append(f"{url}: {e}")
+                continue
+            if entry is None:
+                if VERBOSE_OUTPUT:
+                    print(f"{url} is up to date")
+                continue
+            state[url] = entry
+            written.append(file_path)
+            extract_data_file(file_path)
+            print(f"Downloaded {os.path.basename(file_path)}")
+    if written:
+        # Other batches may have finished in the meantime, so only this batch's entries are merged in
+        with _DOWNLOAD_STATE_LOCK:
+            current_state = read_download_state()
+            current_state.update({url: state[url] for url, _, _ in downloads if url in state})
+            write_download_state(current_state)
+    if failures:
+        raise OSError("Failed to download " + "; ".join(failures))
+    return written
+
+
+def extract_data_file(file_path):
+    if not file_path.endswith(".zip") or STREAM_FROM_ZIP:
+        return
+    print(f"Extracting {file_path}")
+    with zipfile.ZipFile(file_path) as archive:
+        archive.extractall(os.path.dirname(file_path))
+    os.remove(file_path)
+
+
+@timed_stage
+def fetch_data_files(file_names, refresh=False):
+    # Fetches the missing data files (relative to DATA_PATH) at once, and with refresh also the changed ones
+    downloads = []
+    for file_name in file_names:
+        file_path = os.path.join(DATA_PATH, file_name)
+        present = find_data_file(file_path.replace(".zip", ".txt")) is not None
+        if present and not refresh:
+            continue
+        downloads.append((DATA_URL + os.path.basename(file_name), file_path, present))
+    download_files(downloads)
 
-    # Clean up the zip file
-    os.remove(zip_path)
 
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"Expected data file not found: {file_path}")
+def download_and_extract_country_file(country_code, file_path):
+    download_data_files(f"Data/{country_code}.zip", DATA_URL + f"{country_code}.zip")
+    return find_data_file(file_path)
 
 
 def download_data_files(file_name, download_url):
     file_path = os.path.join(DATA_PATH, file_name)
-    print(f"Downloading {download_url}")
-    subprocess.run(["curl", "-o", file_path, download_url], check=True)
-    if file_name.endswith(".zip"):
-        zip_path = file_path
-        print(f"Extracting {zip_path}")
-        subprocess.run(["tar", "-xf", zip_path, "-C", DATA_PATH], check=True)
-        file_path = file_path.replace(".zip", ".txt")
-        os.remove(zip_path)
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"Expected data file not found: {file_path}")
-
-
-def process_town_data(country_code, region_codes, subregion_code):
+    download_files([(download_url, file_path, False)])
+    if not find_data_file(file_path.replace(".zip", ".txt")):
+        raise FileNotFoundError(f"Expected data file not found: {file_path.replace('.zip', '.txt')}")
+
+
+def get_local_data_files():
+    # Returns the merged file and every country file that has been downloaded, as {path: country or None}
+    data_files = {}
+    merged_file = find_data_file(os.path.join(DATA_PATH, "allCountries.txt"))
+    if merged_file is not None:
+        data_files[merged_file] = None
+    country_dir = os.path.join(DATA_PATH, "Data")
+    if os.path.exists(country_dir):
+        for country_code in sorted({os.path.splitext(name)[0] for name in os.listdir(country_dir)
+                                    if name.endswith((".txt", ".zip"))}):
+            file_path = find_data_file(os.path.join(country_dir, f"{country_code}.txt"))
+            if file_path is not None and len(country_code) == 2:
+                data_files[file_path] = country_code
+    return data_files
+
+
+def get_pending_update_dates(data_files):
+    # GeoNames publishes the changes of a day on the next day. Diffs are keyed by geonameid, so applying a
+    # day that a data file already contains does no harm; without a recorded date start at the oldest file
+    try:
+        with open(os.path.join(DATA_PATH, DATA_UPDATE_STATE_FILE), "r", encoding="utf-8") as f:
+            first_date = datetime.strptime(json.load(f)["last_applied"], "%Y-%m-%d").date() + timedelta(days=1)
+    except (OSError, ValueError, KeyError):
+        if not data_files:
+            return []
+        oldest_mtime = min(os.path.getmtime(file_path) for file_path in data_files)
+        first_date = datetime.fromtimestamp(oldest_mtime, timezone.utc).date() - timedelta(days=1)
+    last_date = datetime.now(timezone.utc).date() - timedelta(days=1)
+    return [first_date + timedelta(days=i) for i in range((last_date - first_date).days + 1)]
+
+
+def read_daily_updates(dates):
+    # Returns {geonameid: row} for the changed features in the given days, where a deleted feature has no row
+    update_dir = os.path.join(DATA_PATH, "Updates")
+    downloads = []
+    for date in dates:
+        for kind in ("modifications", "deletes"):
+            file_name = f"{kind}-{date:%Y-%m-%d}.txt"
+            if not os.path.exists(os.path.join(update_dir, file_name)):
+                downloads.append((DATA_URL + file_name, os.path.join(update_dir, file_name), False))
+    download_files(downloads)
+
+    changes = {}
+    for date in dates:
+        # Deletions win over modifications of the same day
+        for kind in ("modifications", "deletes"):
+            with open(os.path.join(update_dir, f"{kind}-{date:%Y-%m-%d}.txt"), "rb") as f:
+                for raw_line in f:
+                    if not raw_line.strip():
+                        continue
+                    geonameid = raw_line.split(b"\t", 1)[COLUMN_GEONAMEID]
+                    changes[geonameid] = raw_line.rstrip(b"\r\n") + b"\n" if kind == "modifications" else None
+    return changes
+
+
+def apply_updates_to_data_file(file_path, country_code, changes):
+    # Rewrites the data file with the changes that concern it and returns the countries of the changed rows
+    country_bytes = country_code.encode() if country_code is not None else None
+    additions = {geonameid: row for geonameid, row in changes.items() if row is not None and (
+        country_bytes is None or row.split(b"\t")[COLUMN_COUNTRY] == country_bytes)}
+    changed_countries = set()
+    temp_path = file_path + ".tmp"
+    if file_path.endswith(".zip"):
+        archive = zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED)
+        output = archive.open(get_zip_member_name(file_path), "w", force_zip64=True)
+    else:
+        archive = None
+        output = open(temp_path, "wb")
+    with output, open_data_file(file_path, binary=True) as f:
+        for raw_line in f:
+            geonameid = raw_line.split(b"\t", 1)[COLUMN_GEONAMEID]
+            if geonameid not in changes:
+                output.write(raw_line if raw_line.endswith(b"\n") else raw_line + b"\n")
+                continue
+            # A modified feature may have moved to another country, in which case it leaves this file
+            row = additions.pop(geonameid, None)
+            if row != raw_line:
+                changed_countries.add(raw_line.split(b"\t")[COLUMN_COUNTRY].decode())
+            if row is not None:
+                output.write(row)
+        for row in additions.values():
+            output.write(row)
+    if archive is not None:
+        archive.close()
+    changed_countries.update(row.split(b"\t")[COLUMN_COUNTRY].decode() for row in additions.values())
+    if changed_countries:
+        os.replace(temp_path, file_path)
+    else:
+        # Untouched files keep their timestamp so their town cache and targets stay valid
+        os.remove(temp_path)
+    return changed_countries
+
+
+@timed_stage
+def update_data_files():
+    # Applies the daily GeoNames diffs since the last update and returns the countries whose data changed
+    data_files = get_local_data_files()
+    dates = get_pending_update_dates(data_files)
+    if not dates:
+        print("Data files are up to date")
+        return set()
+    print(f"Applying GeoNames updates from {dates[0]} to {dates[-1]}")
+    changes = read_daily_updates(dates)
+    changed_countries = set()
+    for file_path, country_code in data_files.items():
+        file_countries = apply_updates_to_data_file(file_path, country_code, changes)
+        if file_countries and VERBOSE_OUTPUT:
+            print(f"Updated {file_path}")
+        changed_countries.update(file_countries)
+
+    state_path = os.path.join(DATA_PATH, DATA_UPDATE_STATE_FILE)
+    with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"last_applied": f"{dates[-1]:%Y-%m-%d}"}, f)
+    os.replace(state_path + ".tmp", state_path)
+    for date in dates:
+        for kind in ("modifications", "deletes"):
+            os.remove(os.path.join(DATA_PATH, "Updates", f"{kind}-{date:%Y-%m-%d}.txt"))
+    return changed_countries
+
+
+def process_town_data(country_code, region_codes, subregion_code, town_records=None):
     region_display = ", ".join(region_codes) if isinstance(region_codes, list) else region_codes
     print(f"Processing {country_code} {region_display} {subregion_code}")
-    try:
+    # town_records may already have been read by a multi-target scan
+    if town_records is None:
+        # Errors reach the caller, which records them as the failure of this target
         input_data = determine_input_data(country_code)
         if VERBOSE_OUTPUT:
             print(f"Data file used: {input_data}")
-    except Exception as e:
-        print(e)
-        return  # or handle error appropriately
-    town_records = read_and_process_towns(input_data, country_code, region_codes, subregion_code)
+        area = get_geo_area(country_code)
+        if area is not None:
+            town_records = read_towns_in_area(input_data, area)
+        else:
+            town_records = read_and_process_towns(input_data, country_code, region_codes, subregion_code)
     town_records = sort_town_records(town_records, SORT_BY_POPULATION)
     town_records = town_records[:MAX_TOWNS]
-    min_weight, scale = calculate_town_weights(town_records)
-    # round num_towns down to nearest 2500 and format with commas
-    num_towns = "{:,}".format(len(town_records) - (len(town_records) % 2500))
-    # get the lowest population town and round to 3 significant figures for readability. format with commas
-    # check if lowest population before formatting is 0
-    # print(len(town_records))
-    # lowest_population = ""
-    if town_records[-1][1] < 100:
-        lowest_population = ""
-    else:
-        lowest_population = "{:,}".format(int(to_precision(town_records[-1][1], 3)))
-        lowest_population = f" that have a population of {lowest_population} and higher"
-    return town_records, min_weight, scale, num_towns, lowest_population
+    if len(town_records) == 0:
+        # nmlc rejects a GRF without names, so no backend builds one
+        raise ValueError(f"No towns found for {country_code} {region_display} {subregion_code}".rstrip())
+    count_build_stat("rows_kept", len(town_records))
+    weights, lowest_population = score_town_records(town_records, WEIGHT_CURVE)
+    return town_records, weights, format_num_towns(len(town_records)), lowest_population
 
 
-def compile_and_deploy_grf(output_nml, output_grf, openttd_dir):
-    os.chdir(os.path.dirname(output_nml))
-    try:
-        subprocess.run(["nmlc", output_nml], check=True)
-        if VERBOSE_OUTPUT:
-            print(f"Compiled {output_nml}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error occurred during compilation: {e}")
+def format_num_towns(count):
+    # round num_towns down to nearest 2500 and format with commas
+    return "{:,}".format(count - (count % 2500))
+
+
+def get_alternate_names_index_path():
+    return os.path.join(CACHE_PATH, ALTERNATE_NAMES_INDEX_FILE)
+
+
+def get_alternate_names_source(file_path):
+    stat = os.stat(file_path)
+    return ALTERNATE_NAMES_INDEX_VERSION, stat.st_size, stat.st_mtime_ns
+
+
+def is_alternate_names_index_current(file_path):
+    index_path = get_alternate_names_index_path()
+    if not os.path.exists(index_path):
+        return False
+    with contextlib.closing(sqlite3.connect(index_path)) as connection:
+        source = connection.execute("SELECT version, size, mtime_ns FROM source").fetchone()
+    return source == get_alternate_names_source(file_path)
+
+
+@timed_stage
+def build_alternate_names_index(file_path):
+    # Keeps one name per (geonameid, language): preferred names before others, full names before short ones,
+    # and the first in file order otherwise. Colloquial and historic names are left out.
+    index_path = get_alternate_names_index_path()
+    temp_path = index_path + ".tmp"
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    print(f"Building alternate names index for {file_path}")
+    pseudo_languages = {language.encode() for language in ALTERNATE_NAMES_PSEUDO_LANGUAGES}
+    insert = ("INSERT INTO names VALUES (?, ?, ?, ?) ON CONFLICT (geonameid, language) "
+              "DO UPDATE SET name = excluded.name, rank = excluded.rank WHERE excluded.rank < names.rank")
+    with contextlib.closing(sqlite3.connect(temp_path)) as connection:
+        # The index is written to a temporary file and renamed when complete, so it needs no journal
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("CREATE TABLE names (geonameid INTEGER, language TEXT, name TEXT, rank INTEGER, "
+                           "PRIMARY KEY (geonameid, language)) WITHOUT ROWID")
+        connection.execute("CREATE TABLE source (version INTEGER, size INTEGER, mtime_ns INTEGER)")
+        batch = []
+        with open_data_file(file_path, binary=True) as f:
+            for raw_line in f:
+                columns = raw_line.rstrip(b"\r\n").split(b"\t")
+                language = columns[ALTERNATE_NAMES_COLUMN_LANGUAGE]
+                if (not language or language in pseudo_languages
+                        or columns[ALTERNATE_NAMES_COLUMN_COLLOQUIAL] == b"1"
+                        or columns[ALTERNATE_NAMES_COLUMN_HISTORIC] == b"1"):
+                    continue
+                rank = ((columns[ALTERNATE_NAMES_COLUMN_PREFERRED] != b"1") * 2
+                        + (columns[ALTERNATE_NAMES_COLUMN_SHORT] == b"1"))
+                batch.append((int(columns[ALTERNATE_NAMES_COLUMN_GEONAMEID]), language.decode(),
+                              columns[ALTERNATE_NAMES_COLUMN_NAME].decode("utf-8"), rank))
+                if len(batch) >= ALTERNATE_NAMES_BATCH_ROWS:
+                    connection.executemany(insert, batch)
+                    batch.clear()
+        connection.executemany(insert, batch)
+        connection.execute("INSERT INTO source VALUES (?, ?, ?)", get_alternate_names_source(file_path))
+        connection.commit()
+    os.replace(temp_path, index_path)
+
+
+def ensure_alternate_names_index():
+    file_path = find_data_file(os.path.join(DATA_PATH, ALTERNATE_NAMES_FILE.replace(".zip", ".txt")))
+    if file_path is None:
+        download_data_files(ALTERNATE_NAMES_FILE, DATA_URL + ALTERNATE_NAMES_FILE)
+        file_path = find_data_file(os.path.join(DATA_PATH, ALTERNATE_NAMES_FILE.replace(".zip", ".txt")))
+    if not is_alternate_names_index_current(file_path):
+        build_alternate_names_index(file_path)
+
+
+@timed_stage
+def localize_town_records(town_records, language):
+    # Looks up only the selected towns in the index. Towns without a name in the language keep their default
+    # name, and a name that occurs twice keeps only its first town, like TownSelector.
+    geonameids = [geonameid for _, _, geonameid in town_records]
+    localized_names = {}
+    with contextlib.closing(sqlite3.connect(get_alternate_names_index_path())) as connection:
+        for start in range(0, len(geonameids), ALTERNATE_NAMES_QUERY_IDS):
+            chunk = geonameids[start:start + ALTERNATE_NAMES_QUERY_IDS]
+            placeholders = ",".join("?" * len(chunk))
+            localized_names.update(connection.execute(
+                f"SELECT geonameid, name FROM names WHERE language = ? AND geonameid IN ({placeholders})",
+                [language, *chunk]))
+    count_build_stat("names_localized", len(localized_names))
+    seen_names = set()
+    localized_records = TownTable()
+    for name, population, geonameid in town_records:
+        if geonameid in localized_names:
+            name = clean_town_name(localized_names[geonameid])
+        if name in seen_names:
+            continue
+        seen_names.add(name)
+        localized_records.append(name, population, geonameid)
+    return localized_records
+
+
+def get_nmlc_command(output_nml, output_grf):
+    # nmlc writes to a temporary file that replaces the GRF once it is complete, so the GRF gets a new inode on
+    # every compile and a hardlinked deployment never changes while OpenTTD reads it
+    return ["nmlc", f"--grf={output_grf}.tmp", output_nml]
+
+
+def finish_nmlc_compile(output_nml, output_grf, returncode, stderr):
+    # Passes on the warnings of nmlc, and raises RuntimeError with its error if the compile failed
+    sys.stderr.write(stderr)
+    if returncode != 0:
+        if os.path.exists(output_grf + ".tmp"):
+            os.remove(output_grf + ".tmp")
+        errors = [line.strip() for line in stderr.splitlines() if line.strip()]
+        raise RuntimeError(errors[-1] if errors else f"nmlc {output_nml} returned exit status {returncode}")
+    os.replace(output_grf + ".tmp", output_grf)
+    if VERBOSE_OUTPUT:
+        print(f"Compiled {output_nml}")
+
+
+def check_deployed(results):
+    # Raises RuntimeError naming every destination deploy_files could not install to
+    failed = [destination_path for destination_path, result in results.items() if result == "failed"]
+    if failed:
+        raise RuntimeError(f"Could not deploy to {', '.join(failed)}")
+
+
+@timed_stage
+def compile_and_deploy_grf(output_nml, output_grf, deploy_dirs):
+    # Raises RuntimeError if nmlc could not compile the GRF or it could not be deployed
+    if NEWGRF_BACKEND != "native":
+        # The native backend already wrote it in write_grf_file
+        process = subprocess.run(get_nmlc_command(output_nml, output_grf), cwd=os.path.dirname(output_nml),
+                                 stderr=subprocess.PIPE, text=True)
+        finish_nmlc_compile(output_nml, output_grf, process.returncode, process.stderr)
+    check_deployed(deploy_files([output_grf], deploy_dirs))
+
+
+async def compile_and_deploy_grf_async(output_nml, output_grf, deploy_dirs):
+    # Same as compile_and_deploy_grf, with nmlc running as a subprocess of the event loop
+    import asyncio
+
+    if NEWGRF_BACKEND != "native":
+        process = await asyncio.create_subprocess_exec(*get_nmlc_command(output_nml, output_grf),
+                                                       cwd=os.path.dirname(output_nml),
+                                                       stderr=asyncio.subprocess.PIPE)
+        _, stderr = await process.communicate()
+        finish_nmlc_compile(output_nml, output_grf, process.returncode, stderr.decode(errors="replace"))
+    check_deployed(deploy_files([output_grf], deploy_dirs))
+
+
+def clone_file(source_path, destination_path):
+    # Creates destination_path with the contents of source_path as a hardlink, a reflink or a copy made by the
+    # kernel, whichever works first, and returns which one it was
+    if DEPLOY_HARDLINKS:
+        try:
+            os.link(source_path, destination_path)
+            return "hardlink"
+        except OSError:
+            pass  # Other file system, or links are not supported
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+                return "reflink"
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(source.fileno(), destination.fileno(), DOWNLOAD_CHUNK_SIZE):
+                    pass
+                return "copy_file_range"
+            except OSError:
+                source.seek(0)
+                destination.seek(0)
+                destination.truncate()
+        shutil.copyfileobj(source, destination, DOWNLOAD_CHUNK_SIZE)
+    return "copy"
+
+
+def install_file(source_path, destination_dir, hash_source=hash_file):
+    # Returns how the file was installed, or "unchanged" if the destination already has the same contents.
+    # The file is written next to the destination and renamed over it, so it is never seen half written.
+    destination_path = os.path.join(destination_dir, os.path.basename(source_path))
+    if os.path.exists(destination_path):
+        if os.path.samefile(source_path, destination_path):
+            return "unchanged"
+        if (os.path.getsize(destination_path) == os.path.getsize(source_path)
+                and hash_file(destination_path) == hash_source(source_path)):
+            return "unchanged"
+    temp_path = f"{destination_path}.{os.getpid()}.tmp"
     try:
-        subprocess.run(["copy", output_grf, openttd_dir],
-                       shell=True,
-                       check=True)
-        if VERBOSE_OUTPUT:
-            print(f"Deployed {output_grf} to {openttd_dir}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error occurred during deployment: {e}")
-
-
-def manage_id_assignments(output_nml):
+        method = clone_file(source_path, temp_path)
+        if method != "hardlink":
+            shutil.copystat(source_path, temp_path)
+        os.replace(temp_path, destination_path)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+    return method
+
+
+@timed_stage
+def deploy_files(file_paths, destination_dirs):
+    # Installs every file in every destination directory, and returns {destination path: install result}.
+    # Each file is hashed at most once, however many destinations compare against it.
+    hash_source = functools.lru_cache(maxsize=None)(hash_file)
+    results = {}
+    for file_path in file_paths:
+        for destination_dir in destination_dirs:
+            destination_path = os.path.join(destination_dir, os.path.basename(file_path))
+            try:
+                os.makedirs(destination_dir, exist_ok=True)
+                results[destination_path] = install_file(file_path, destination_dir, hash_source)
+            except OSError as e:
+                print(f"Error occurred during deployment: {e}")
+                results[destination_path] = "failed"
+                continue
+            if VERBOSE_OUTPUT:
+                if results[destination_path] == "unchanged":
+                    print(f"{file_path} is already deployed to {destination_dir}")
+                else:
+                    print(f"Deployed {file_path} to {destination_dir} ({results[destination_path]})")
+    return results
+
+
+def hash_build_inputs(town_records):
+    # Everything that affects the generated files apart from the version number and date
+    digest = hashlib.sha256()
+    settings = [GENERATOR_VERSION, MAX_TOWNS, POPULATION_THRESHOLD, SORT_BY_POPULATION, WEIGHT_CURVE,
+                NML_BOILERPLATE, LANG_FILE_BOILERPLATE]
+    digest.update(json.dumps(settings).encode("utf-8"))
+    for name, population, _ in town_records:
+        digest.update(f"{name}\t{population}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def hash_build_sources(target, language=None):
+    # The data files and settings an output of the target is built from, known before any row is read.
+    # None when the data file has not been downloaded yet.
+    data_file = find_data_file(os.path.join(DATA_PATH, get_data_file_name(target[0]).replace(".zip", ".txt")))
+    if data_file is None:
+        return None
+    source_files = [data_file] + [os.path.join(DATA_PATH, file_name)
+                                  for file_name in ("countryInfo.txt", "admin1CodesASCII.txt", "admin2Codes.txt",
+                                                    "countries.csv")]
+    if language is not None:
+        source_files.append(get_alternate_names_index_path())
+    sources = [GENERATOR_VERSION, target, language, MAX_TOWNS, POPULATION_THRESHOLD, SORT_BY_POPULATION,
+               WEIGHT_CURVE, COLUMN_TYPE_SUB_TYPE, COLLAPSE_NEAR_DUPLICATES, FUZZY_NEAR_DUPLICATES, WORLD_QUOTAS,
+               WORLD_QUOTA_STRATUM, WORLD_QUOTA_CAP, WORLD_QUOTA_SEED, NML_BOILERPLATE, LANG_FILE_BOILERPLATE]
+    for file_path in source_files:
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            sources.append([file_path, stat.st_size, stat.st_mtime_ns])
+        else:
+            sources.append([file_path, None, None])
+    return hashlib.sha256(json.dumps(sources).encode("utf-8")).hexdigest()
+
+
+def is_build_up_to_date(output_dir, output_grf, inputs_hash, key="inputs_hash"):
+    manifest_path = os.path.join(output_dir, BUILD_MANIFEST_FILE)
+    if FORCE_REBUILD or not os.path.exists(manifest_path) or not os.path.exists(output_grf):
+        return False
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    return manifest.get(key) == inputs_hash
+
+
+def is_target_up_to_date(target):
+    # True when every output of the target was built from the same data files and settings, so the target is
+    # skipped before its data file is read
+    for language, location_dir in zip([None] + TOWN_NAME_LANGUAGES, get_output_location_dirs(*target)):
+        output_dir = os.path.join(SOURCE_FILES_PATH, location_dir)
+        sources_hash = hash_build_sources(target, language)
+        if sources_hash is None or not is_build_up_to_date(
+                output_dir, os.path.join(output_dir, f"{location_dir}.grf"), sources_hash, "sources_hash"):
+            return False
+    return True
+
+
+def write_build_manifest(output_dir, inputs_hash, grf_id, version, sources_hash=None):
+    with open(os.path.join(output_dir, BUILD_MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({"inputs_hash": inputs_hash, "sources_hash": sources_hash, "grf_id": grf_id, "version": version},
+                  f, indent=4)
+
+
+def update_build_manifest_sources(output_dir, sources_hash):
+    # Data files changed but the towns did not, so the next run can skip the output before reading them
+    manifest_path = os.path.join(output_dir, BUILD_MANIFEST_FILE)
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    write_build_manifest(output_dir, manifest["inputs_hash"], manifest.get("grf_id"), manifest.get("version"),
+                         sources_hash)
+
+
+class FileLock:
+    # Cross-process lock around file_id.txt or a town cache build. The lock belongs to the open lock file, so the
+    # operating system releases it when a build is killed and a lock file left behind never blocks later builds.
+    def __init__(self, lock_path, timeout=ID_LOCK_TIMEOUT):
+        self.lock_path = lock_path
+        self.timeout = timeout
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.lock_path, "a+b")
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    self.file.seek(0)
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+                return self
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.file.close()
+                    raise TimeoutError(f"Timed out waiting for another build to release {self.lock_path}")
+                time.sleep(0.05)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+
+
+def read_id_assignments():
     id_assignments = {}
-    id_used = set()
-    id_gap = None
-
     # Read existing assignments and populate the dictionary
     if os.path.exists(ID_FILE):
         with open(ID_FILE, "r") as file:
@@ -420,30 +2416,77 @@ def manage_id_assignments(output_nml):
                         int(parts[2].strip()),
                     )
                     id_assignments[location_dir] = (grf_id, version)
-                    id_used.add(int(grf_id[2:]))
-    # Find the smallest unused ID in the existing sequence
-    for i in range(1, len(id_assignments) + 2):  # +2 to ensure a new ID if all are used sequentially
-        if i not in id_used:
-            id_gap = f"TA{i:02}"
-            break
-    # Assign ID and version
-    if output_nml in id_assignments:
-        grf_id, version = id_assignments[output_nml]
-        version += 1  # Increment version if already exists
-    else:
-        grf_id = id_gap if id_gap else f"TA{len(id_assignments) + 1:02}"
-        version = 1
-    # Update the dictionary with the new or updated version
-    id_assignments[output_nml] = (grf_id, version)
+    return id_assignments
+
 
+def write_id_assignments(id_assignments):
     # Write all data back to the file
-    with open(ID_FILE, "w") as file:
+    with open(ID_FILE + ".tmp", "w") as file:
         for location, (id_, ver) in id_assignments.items():
             file.write(f"{location},{id_},{ver}\n")
+    os.replace(ID_FILE + ".tmp", ID_FILE)
+
+
+def format_grf_id(number):
+    # TA01 to TA99, then TB00 to TZ99, so GRF IDs always stay four bytes
+    if number >= 26 * 100:
+        raise ValueError(f"No GRF IDs left in {ID_FILE}")
+    return f"T{chr(ord('A') + number // 100)}{number % 100:02}"
+
+
+def parse_grf_id(grf_id):
+    return (ord(grf_id[1]) - ord("A")) * 100 + int(grf_id[2:])
+
+
+def get_unused_grf_id(id_assignments):
+    id_used = {parse_grf_id(grf_id) for grf_id, _ in id_assignments.values()}
+    # Find the smallest unused ID in the existing sequence
+    for i in range(1, len(id_assignments) + 2):  # +2 to ensure a new ID if all are used sequentially
+        if i not in id_used:
+            return format_grf_id(i)
+    return format_grf_id(len(id_assignments) + 1)
+
+
+def get_server_grf_id(location_dir):
+    # Packs of the build server get an ID from their name instead of file_id.txt, so requests never reserve IDs.
+    # The second character is never an upper case letter like in the IDs of file_id.txt.
+    digest = hashlib.sha256(location_dir.encode("utf-8")).digest()
+    return "T" + "".join(SERVER_GRF_ID_CHARACTERS[byte % len(SERVER_GRF_ID_CHARACTERS)] for byte in digest[:3])
+
+
+def reserve_id_assignments(location_dirs):
+    # Assign GRF IDs to new targets up front, in input order, so parallel builds get the same IDs as a serial run.
+    # Reserved entries start at version 0 and get version 1 on their first build.
+    with FileLock(ID_FILE + ".lock"):
+        id_assignments = read_id_assignments()
+        for location_dir in location_dirs:
+            if location_dir not in id_assignments:
+                id_assignments[location_dir] = (get_unused_grf_id(id_assignments), 0)
+        write_id_assignments(id_assignments)
+
+
+@timed_stage
+def manage_id_assignments(output_nml):
+    with FileLock(ID_FILE + ".lock"):
+        id_assignments = read_id_assignments()
+        # Assign ID and version
+        if output_nml in id_assignments:
+            grf_id, version = id_assignments[output_nml]
+            version += 1  # Increment version if already exists
+        else:
+            grf_id = get_unused_grf_id(id_assignments)
+            version = 1
+        # Update the dictionary with the new or updated version
+        id_assignments[output_nml] = (grf_id, version)
+        write_id_assignments(id_assignments)
     return grf_id, version
 
 
-def process_country_region(country_code, region_codes, subregion_code):
+def get_location_dir(country_code, region_codes, subregion_code):
+    area = get_geo_area(country_code)
+    if area is not None:
+        return f"Taby_{area.slug}_Town_Names"
+
     # Adjust file paths and names based on country and region
     country_file_code = country_code if country_code else "World"
 
@@ -455,20 +2498,120 @@ def process_country_region(country_code, region_codes, subregion_code):
         # Single region
         region_str = region_codes if isinstance(region_codes, str) else (region_codes[0] if region_codes else "")
 
-    location_dir = f"Taby_{country_file_code}{'_' + region_str if region_str else ''}{'_' + subregion_code if subregion_code else ''}_Town_Names"
-    output_dir = os.path.join(BASE_PATH, "Source_Files", location_dir)
-    output_nml = os.path.join(
-        output_dir,
-        f"Taby_{country_file_code}{'_' + region_str if region_str else ''}{'_' + subregion_code if subregion_code else ''}_Town_Names.nml",
-    )
-    output_grf = os.path.join(
-        output_dir,
-        f"Taby_{country_file_code}{'_' + region_str if region_str else ''}{'_' + subregion_code if subregion_code else ''}_Town_Names.grf",
-    )
+    return f"Taby_{country_file_code}{'_' + region_str if region_str else ''}{'_' + subregion_code if subregion_code else ''}_Town_Names"
+
+
+class TargetBuild:
+    """Report data of one target, collected over the stages it goes through."""
+
+    def __init__(self, target):
+        self.target = target
+        self.location_dir = get_location_dir(*target)
+        self.stats = BuildStats()
+        self.profiler = cProfile.Profile() if PROFILE_SLOWEST_TARGET else None
+        self.wall_seconds = 0.0
+        self.status = None
+        self.error = None
+
+    @contextlib.contextmanager
+    def stage(self):
+        # Collects stats and profile data of the target in the current thread
+        start = time.perf_counter()
+        with collect_build_stats(self.stats):
+            if self.profiler is not None:
+                self.profiler.enable()
+            try:
+                yield
+            finally:
+                if self.profiler is not None:
+                    self.profiler.disable()
+                self.wall_seconds += time.perf_counter() - start
+
+    def report(self):
+        if self.status == "failed":
+            return {"target": self.location_dir, "status": "failed", "error": self.error}
+        report = {"target": self.location_dir, "status": self.status, "wall_seconds": round(self.wall_seconds, 4),
+                  **self.stats.report()}
+        if self.profiler is not None:
+            report["profile"] = os.path.join(SOURCE_FILES_PATH, self.location_dir, PROFILE_FILE)
+            self.profiler.dump_stats(report["profile"])
+        return report
+
+
+def process_country_region(country_code, region_codes, subregion_code, town_records=None):
+    # Builds one target and returns its entry for the build report
+    build = TargetBuild((country_code, region_codes, subregion_code))
+    with build.stage():
+        build.status = build_country_region(country_code, region_codes, subregion_code, town_records)
+    return build.report()
+
+
+def get_output_location_dirs(country_code, region_codes, subregion_code):
+    # The target's own output directory, followed by one per localized language
+    location_dir = get_location_dir(country_code, region_codes, subregion_code)
+    return [location_dir] + [f"{location_dir}_{language}" for language in TOWN_NAME_LANGUAGES]
+
+
+def build_country_region(country_code, region_codes, subregion_code, town_records=None):
+    # Returns "built", or "skipped" when nothing changed since the last build of any of its GRFs
+    outputs = prepare_country_region(country_code, region_codes, subregion_code, town_records)
+    for output in outputs:
+        compile_and_deploy_grf(output["nml"], output["grf"], get_deploy_dirs())
+        finish_town_names_output(output)
+    return "built" if outputs else "skipped"
+
+
+def deploy_existing_grfs(location_dirs):
+    # Skipped outputs are deployed too, so deploy directories added since their last build get them.
+    # Destinations that already have the same GRF are left alone.
+    output_grfs = [os.path.join(SOURCE_FILES_PATH, location_dir, f"{location_dir}.grf")
+                   for location_dir in location_dirs]
+    check_deployed(deploy_files(output_grfs, get_deploy_dirs()))
+
+
+def prepare_country_region(country_code, region_codes, subregion_code, town_records=None):
+    # Writes the NML (and native GRF) of every output of the target that changed, and returns those outputs
+    target = (country_code, region_codes, subregion_code)
+    location_dirs = get_output_location_dirs(*target)
+    if town_records is None and is_target_up_to_date(target):
+        region_display = ", ".join(region_codes) if isinstance(region_codes, list) else region_codes
+        print(f"Skipped {country_code} {region_display} {subregion_code}, nothing changed")
+        deploy_existing_grfs(location_dirs)
+        return []
+    town_records, weights, num_towns, lowest_population = process_town_data(*target, town_records)
+    outputs = [prepare_town_names_output(location_dirs[0], target, town_records, weights, num_towns,
+                                         lowest_population)]
+    if TOWN_NAME_LANGUAGES:
+        ensure_alternate_names_index()
+    for language, location_dir in zip(TOWN_NAME_LANGUAGES, location_dirs[1:]):
+        localized_records = localize_town_records(town_records, language)
+        weights, lowest_population = score_town_records(localized_records, WEIGHT_CURVE)
+        outputs.append(prepare_town_names_output(location_dir, target, localized_records, weights,
+                                                 format_num_towns(len(localized_records)), lowest_population,
+                                                 language))
+    return [output for output in outputs if output is not None]
+
+
+def prepare_town_names_output(location_dir, target, town_records, weights, num_towns, lowest_population,
+                              language=None):
+    # Returns None when the output is up to date, otherwise what finish_town_names_output needs after compiling
+    country_code, region_codes, subregion_code = target
+    output_dir = os.path.join(SOURCE_FILES_PATH, location_dir)
+    output_nml = os.path.join(output_dir, f"{location_dir}.nml")
+    output_grf = os.path.join(output_dir, f"{location_dir}.grf")
     prepare_output_dir(output_dir)
 
-    town_records, min_weight, scale, num_towns, lowest_population = process_town_data(
-        country_code, region_codes, subregion_code)
+    region_display = ", ".join(region_codes) if isinstance(region_codes, list) else region_codes
+    if language is not None:
+        region_display = f"{region_display} ({language})"
+    # Skip unchanged targets entirely so they are not recompiled and keep their version
+    sources_hash = hash_build_sources(target, language)
+    inputs_hash = hash_build_inputs(town_records)
+    if is_build_up_to_date(output_dir, output_grf, inputs_hash):
+        update_build_manifest_sources(output_dir, sources_hash)
+        print(f"Skipped {country_code} {region_display} {subregion_code}, nothing changed")
+        deploy_existing_grfs([location_dir])
+        return None
 
     # Assuming ID and other operations are similar for each pair
     grf_id, version = manage_id_assignments(location_dir)
@@ -481,20 +2624,23 @@ def process_country_region(country_code, region_codes, subregion_code):
         version,
         num_towns,
         lowest_population,
+        language,
     )
 
-    write_nml_file(output_nml, grf_id, version, town_records, min_weight, scale)
-    if USE_OPENTTD_DIR:
-        compile_and_deploy_grf(output_nml, output_grf, OPENTTD_DIR)
-    else:
-        if not os.path.exists(BASE_PATH + "/Output"):
-            os.makedirs(BASE_PATH + "/Output", exist_ok=True)
-        compile_and_deploy_grf(output_nml, output_grf, BASE_PATH + "\\Output")
+    write_nml_file(output_nml, grf_id, version, town_records, weights)
+    if NEWGRF_BACKEND == "native":
+        write_grf_file(output_grf, grf_id, version, town_records, weights,
+                       os.path.join(output_dir, "lang", "english.lng"))
+    message = f"Processed {len(town_records)} towns names for {country_code} {region_display} {subregion_code}"
+    return {"dir": output_dir, "nml": output_nml, "grf": output_grf, "inputs_hash": inputs_hash,
+            "sources_hash": sources_hash, "grf_id": grf_id, "version": version, "message": message}
 
-    region_display = ", ".join(region_codes) if isinstance(region_codes, list) else region_codes
-    print(
-        f"Processed {len(town_records)} towns names for {country_code} {region_display} {subregion_code}"
-    )
+
+def finish_town_names_output(output):
+    # Only called once the GRF is compiled, so a failed compile is retried by the next build
+    write_build_manifest(output["dir"], output["inputs_hash"], output["grf_id"], output["version"],
+                         output["sources_hash"])
+    print(output["message"])
 
 
 def take_input():
@@ -522,10 +2668,17 @@ def split_input(code):
     - Country.Region: "US.VT"
     - Country.Region.Subregion: "US.VT.001"
     - Multiple regions (comma-separated): "US.MA, US.NH, US.VT"
+    - Bounding box: "bbox:47.5,1.5,49.5,3.5" or with a label "bbox:47.5,1.5,49.5,3.5:Paris Basin"
+    - Radius in km: "radius:48.8566,2.3522,150:Paris"
 
     Returns: (country_code, region_codes, subregion_code)
-    where region_codes can be a string or list
+    where region_codes can be a string or list, and country_code is the whole code for bbox and radius targets
     """
+    if code.strip().startswith(("bbox:", "radius:")):
+        # Raises ValueError for malformed codes before anything is built
+        get_geo_area(code.strip())
+        return code.strip(), "", ""
+
     # Check if there are commas (multiple regions)
     if "," in code:
         # Split by comma first
@@ -558,27 +2711,550 @@ def split_input(code):
     return country_code, region_code, subregion_code
 
 
-def main():
+def get_settings():
+    return {name: globals()[name] for name in CONFIGURABLE_SETTINGS}
+
+
+def apply_settings(settings):
+    unknown = set(settings) - set(CONFIGURABLE_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+    globals().update(settings)
+
+
+def init_build_worker(settings):
+    # Worker processes may re-import this module (spawn), so copy over settings resolved in main()
+    apply_settings(settings)
+
+
+def get_failed_report(target, error):
+    return {"target": get_location_dir(*target), "status": "failed", "error": str(error)}
+
+
+def build_targets(targets, target_records, jobs, scan_errors=None):
+    # Returns a build report entry for every target in input order; a failing target never stops the others.
+    # Targets in scan_errors already failed when their data file was read and are not built.
+    scan_errors = scan_errors or {}
+    reports = [None] * len(targets)
+    for index, error in scan_errors.items():
+        reports[index] = get_failed_report(targets[index][1], error)
+    if jobs <= 1:
+        for i, ((code, target), town_records) in enumerate(zip(targets, target_records), start=1):
+            if i - 1 not in scan_errors:
+                try:
+                    reports[i - 1] = process_country_region(*target, town_records)
+                except Exception as e:
+                    print(f"Failed to build {code or 'World'}: {e}")
+                    reports[i - 1] = get_failed_report(target, e)
+            print(f"Processed {i} of {len(targets)}")
+        return reports
+
+    reserve_id_assignments([location_dir for _, target in targets
+                            for location_dir in get_output_location_dirs(*target)])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                initializer=init_build_worker,
+                                                initargs=(get_settings(),)) as executor:
+        futures = {executor.submit(process_country_region, *target, town_records): index
+                   for index, ((_, target), town_records) in enumerate(zip(targets, target_records))
+                   if index not in scan_errors}
+        for i, future in enumerate(concurrent.futures.as_completed(futures), start=len(scan_errors) + 1):
+            index = futures[future]
+            code, target = targets[index]
+            try:
+                reports[index] = future.result()
+            except Exception as e:
+                print(f"Failed to build {code or 'World'}: {e}")
+                reports[index] = get_failed_report(target, e)
+            print(f"Processed {i} of {len(targets)}")
+    return reports
+
+
+class LineOutput:
+    """
+    Stream wrapper that writes whole lines only. print writes the text and the line end separately, so prints of
+    the pipeline worker thread and of the event loop thread could otherwise end up on the same line.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.pending = threading.local()
+
+    def write(self, text):
+        lines, newline, rest = (getattr(self.pending, "text", "") + text).rpartition("\n")
+        self.pending.text = rest
+        if newline:
+            with self.lock:
+                self.stream.write(lines + newline)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+async def run_build_pipeline(targets):
+    """
+    Builds the targets with their stages overlapped: data files download while earlier ones are scanned, and
+    nmlc compiles earlier targets while later ones are prepared. Scanning and preparing run in one worker thread,
+    as they hold the GIL. Returns the build reports in input order and the shared stats report.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    shared_stats = BuildStats()
+    builds = [TargetBuild(target) for _, target in targets]
+    queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    completed = 0
+
+    async def compile_outputs():
+        nonlocal completed
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            build, outputs = item
+            try:
+                for output in outputs:
+                    start = time.perf_counter()
+                    with build.stats.stage("compile_and_deploy_grf"):
+                        await compile_and_deploy_grf_async(output["nml"], output["grf"], get_deploy_dirs())
+                    finish_town_names_output(output)
+                    build.wall_seconds += time.perf_counter() - start
+            except Exception as e:
+                print(f"Failed to build {build.location_dir}: {e}")
+                build.status, build.error = "failed", str(e)
+            completed += 1
+            print(f"Processed {completed} of {len(builds)}")
+
+    def prepare(build, town_records):
+        with build.stage():
+            return prepare_country_region(*build.target, town_records)
+
+    # Targets are prepared grouped by data file, so new targets get their IDs up front like in a serial run
+    reserve_id_assignments([location_dir for _, target in targets
+                            for location_dir in get_output_location_dirs(*target)])
+    build_indexes_by_file = {}
+    for index, (_, target) in enumerate(targets):
+        build_indexes_by_file.setdefault(get_data_file_name(target[0]), []).append(index)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, DOWNLOAD_JOBS)) as download_executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as worker, \
+            contextlib.redirect_stdout(LineOutput(sys.stdout)):
+        if UPDATE_DATA or TOWN_NAME_LANGUAGES:
+            # Updates and the alternate names index need every download first, so nothing is overlapped
+            await loop.run_in_executor(worker, run_with_build_stats, shared_stats, fetch_shared_data, targets)
+            downloads = {}
+        else:
+            metadata_download = loop.run_in_executor(download_executor, run_with_build_stats, shared_stats,
+                                                     fetch_data_files, LIST_OF_DATA_FILES, REFRESH_DATA)
+            downloads = {file_name: loop.run_in_executor(download_executor, run_with_build_stats, shared_stats,
+                                                         fetch_data_files, [file_name], REFRESH_DATA)
+                         for file_name in build_indexes_by_file}
+            downloads[None] = metadata_download
+        compilers = [asyncio.create_task(compile_outputs()) for _ in range(max(1, PIPELINE_COMPILE_JOBS))]
+        for file_name, build_indexes in build_indexes_by_file.items():
+            for download in (downloads.get(None), downloads.get(file_name)):
+                if download is None:
+                    continue
+                try:
+                    await download
+                except OSError as e:
+                    # Targets retry their own data file when they are prepared and fail on their own
+                    print(e)
+            # Targets of a data file that cannot be read fail, the other data files are still built
+            scan_errors = {}
+            file_records = [None] * len(build_indexes)
+            if MULTI_TARGET_SCAN:
+                try:
+                    file_records = await loop.run_in_executor(
+                        worker, run_with_build_stats, shared_stats, read_towns_for_targets,
+                        [builds[index].target for index in build_indexes], scan_errors)
+                except Exception as e:
+                    print(f"Failed to read {file_name}: {e}")
+                    scan_errors = dict.fromkeys(range(len(build_indexes)), f"Failed to read {file_name}: {e}")
+            for position, (index, town_records) in enumerate(zip(build_indexes, file_records)):
+                build = builds[index]
+                outputs = []
+                if position in scan_errors:
+                    build.status, build.error = "failed", scan_errors[position]
+                else:
+                    try:
+                        outputs = await loop.run_in_executor(worker, prepare, build, town_records)
+                    except Exception as e:
+                        print(f"Failed to build {targets[index][0] or 'World'}: {e}")
+                        build.status, build.error = "failed", str(e)
+                    else:
+                        build.status = "built" if outputs else "skipped"
+                await queue.put((build, outputs))
+        for _ in compilers:
+            await queue.put(None)
+        await asyncio.gather(*compilers)
+    return [build.report() for build in builds], shared_stats.report()
+
+
+def fetch_shared_data(targets):
+    # Fetches the metadata and every data file the targets read in one concurrent batch, then applies the
+    # daily updates and builds the alternate names index if they are enabled
+    data_files = LIST_OF_DATA_FILES + sorted({get_data_file_name(target[0]) for _, target in targets})
+    if TOWN_NAME_LANGUAGES:
+        data_files.append(ALTERNATE_NAMES_FILE)
+    try:
+        fetch_data_files(data_files, REFRESH_DATA)
+    except OSError as e:
+        # Targets retry their own data file when they are built and fail on their own if it is still missing
+        print(e)
+    try:
+        fetch_license_file()
+    except OSError as e:
+        print(e)
+    if UPDATE_DATA:
+        try:
+            changed_countries = update_data_files()
+        except OSError as e:
+            print(f"Could not apply the GeoNames updates, use --refresh-data to download full files ({e})")
+        else:
+            # Data files without changes keep their timestamps, so only targets of these countries are rebuilt
+            print(f"Data changed for: {', '.join(sorted(changed_countries)) or 'no countries'}")
+    if TOWN_NAME_LANGUAGES:
+        # Built once here so parallel builds only read it
+        try:
+            ensure_alternate_names_index()
+        except OSError as e:
+            print(e)
+
+
+def keep_slowest_profile(reports):
+    # Moves the profile of the slowest built target to PROFILE_FILE and removes the others
+    profiled = [report for report in reports if "profile" in report]
+    if not profiled:
+        return None
+    slowest = max(profiled, key=lambda report: report["wall_seconds"])
+    profile_path = os.path.join(SOURCE_FILES_PATH, PROFILE_FILE)
+    os.replace(slowest["profile"], profile_path)
+    for report in profiled:
+        if report is not slowest:
+            os.remove(report["profile"])
+        del report["profile"]
+    print(f"Profile of the slowest target {slowest['target']} written to {profile_path}")
+    return profile_path
+
+
+def write_build_report(report):
+    report_path = os.path.join(SOURCE_FILES_PATH, BUILD_REPORT_FILE)
+    with open(report_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    os.replace(report_path + ".tmp", report_path)
+    if VERBOSE_OUTPUT:
+        print(f"Build report written to {report_path}")
+
+
+def build_pack(code, output_format, language, data_stamp):
+    """
+    Returns the GRF or NML of one target, built in a scratch directory. Unlike a normal build it does not
+    reserve an ID in file_id.txt, write to the source files directory or deploy anything. The version is the
+    day of the data file, and data_stamp also keys the server cache to that version of the data file.
+    """
+    target = split_input(code)
+    location_dir = get_location_dir(*target) + (f"_{language}" if language is not None else "")
+    town_records, weights, num_towns, lowest_population = process_town_data(*target)
+    if language is not None:
+        ensure_alternate_names_index()
+        town_records = localize_town_records(town_records, language)
+        weights, lowest_population = score_town_records(town_records, WEIGHT_CURVE)
+        num_towns = format_num_towns(len(town_records))
+    grf_id = get_server_grf_id(location_dir)
+    version = data_stamp[2] // (86400 * 10 ** 9)
+    with tempfile.TemporaryDirectory(prefix="taby_pack_") as output_dir:
+        output_nml = os.path.join(output_dir, f"{location_dir}.nml")
+        output_grf = os.path.join(output_dir, f"{location_dir}.grf")
+        os.makedirs(os.path.join(output_dir, "lang"))
+        with open(os.path.join(output_dir, "lang", "english.lng"), "w", encoding="utf-8") as f:
+            f.write(LANG_FILE_BOILERPLATE)
+        update_language_file(output_dir, *target, version, num_towns, lowest_population, language)
+        write_nml_file(output_nml, grf_id, version, town_records, weights)
+        if output_format == "nml":
+            with open(output_nml, "rb") as f:
+                return f.read()
+        if NEWGRF_BACKEND == "native":
+            write_grf_file(output_grf, grf_id, version, town_records, weights,
+                           os.path.join(output_dir, "lang", "english.lng"))
+        compile_and_deploy_grf(output_nml, output_grf, [])
+        with open(output_grf, "rb") as f:
+            return f.read()
+
+
+def parse_target_code(code):
+    # split_input for codes from requests. Raises ValueError unless every code of the target is in the GeoNames
+    # metadata, so request input never reaches file paths or download URLs unchecked.
+    code = code.strip()
+    target = split_input(code)
+    country_code, region_codes, subregion_code = target
+    if get_geo_area(country_code) is not None:
+        return target
+    region_codes = normalize_region_codes(region_codes)
+    # split_input ignores what it does not understand, so the target has to give back the same code
+    if "," in code:
+        expected = ", ".join(f"{country_code}.{region_code}" for region_code in region_codes)
+    else:
+        expected = ".".join(part for part in (country_code, *region_codes, subregion_code) if part)
+    if code.replace(" ", "") != expected.replace(" ", ""):
+        raise ValueError(f"Malformed target {code!r}")
+    if not country_code:
+        return target
+    if country_code not in load_metadata_index(os.path.join(DATA_PATH, "countryInfo.txt"), parse_geonames_codes):
+        raise ValueError(f"Unknown country code {country_code!r}")
+    admin1_codes = load_metadata_index(os.path.join(DATA_PATH, "admin1CodesASCII.txt"), parse_geonames_codes)
+    for region_code in region_codes:
+        if f"{country_code}.{region_code}" not in admin1_codes:
+            raise ValueError(f"Unknown region code {country_code}.{region_code!r}")
+    if subregion_code:
+        admin2_codes = load_metadata_index(os.path.join(DATA_PATH, "admin2Codes.txt"), parse_geonames_codes)
+        if len(region_codes) != 1 or f"{country_code}.{region_codes[0]}.{subregion_code}" not in admin2_codes:
+            raise ValueError(f"Unknown subregion code {subregion_code!r}")
+    return target
+
+
+def get_data_stamp(country_code):
+    input_data = determine_input_data(country_code)
+    stat = os.stat(input_data)
+    return input_data, stat.st_size, stat.st_mtime_ns
+
+
+class BuildRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves GET /build?target=CODE[&format=grf|nml][&lang=LANGUAGE], where CODE uses the grammar of split_input.
+    Requests are handled one at a time, as builds share the resident town cache partitions.
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/build":
+            self.send_error(404, "Use /build?target=CODE")
+            return
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        code = query.get("target", [""])[0].strip()
+        output_format = query.get("format", ["grf"])[0]
+        language = query.get("lang", [None])[0]
+        if output_format not in ("grf", "nml"):
+            self.send_error(400, "format must be grf or nml")
+            return
+        if language is not None and language not in TOWN_NAME_LANGUAGES:
+            self.send_error(400, f"lang must be one of: {', '.join(TOWN_NAME_LANGUAGES)}")
+            return
+        try:
+            target = parse_target_code(code)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        try:
+            body = self.server.build_pack(code, output_format, language, get_data_stamp(target[0]))
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        location_dir = get_location_dir(*target) + (f"_{language}" if language is not None else "")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8" if output_format == "nml"
+                         else "application/octet-stream")
+        self.send_header("Content-Disposition", f'attachment; filename="{location_dir}.{output_format}"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if VERBOSE_OUTPUT:
+            super().log_message(format, *args)
+
+
+def serve(address, warm_codes):
+    # Keeps metadata, town cache partitions and recently generated packs in memory between requests
+    global _RESIDENT_PARTITIONS
+    _RESIDENT_PARTITIONS = {}
+    host, _, port = address.rpartition(":")
+    try:
+        fetch_data_files(LIST_OF_DATA_FILES, REFRESH_DATA)
+    except OSError as e:
+        print(e)
+    server = http.server.HTTPServer((host or "127.0.0.1", int(port)), BuildRequestHandler)
+    server.build_pack = functools.lru_cache(maxsize=SERVER_CACHE_SIZE)(build_pack)
+    for code in warm_codes:
+        try:
+            target = parse_target_code(code)
+            server.build_pack(code.strip(), "grf" if NEWGRF_BACKEND == "native" else "nml", None,
+                              get_data_stamp(target[0]))
+        except Exception as e:
+            print(f"Failed to build {code or 'World'}: {e}")
+    print(f"Serving town name packs on http://{server.server_address[0]}:{server.server_address[1]}/build")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate Taby Town Names NewGRFs from GeoNames data.",
+        epilog="Settings are taken from the constants at the top of this script, then the --config file, "
+               "then the command line.")
+    parser.add_argument("targets", nargs="*", metavar="TARGET",
+                        help='country[.region[.subregion]] codes such as GB, GB.ENG or US.NY.061, '
+                             '"US.MA, US.VT" for several regions, or "" for the world (default: DATA_INPUT)')
+    parser.add_argument("--config", metavar="FILE",
+                        help="JSON file mapping setting names (such as MAX_TOWNS) to values")
+    parser.add_argument("--non-interactive", action="store_true",
+                        help="never prompt, even when run from a terminal")
+    parser.add_argument("--jobs", type=int, dest="BUILD_JOBS", metavar="N",
+                        help="number of targets to build in parallel")
+    parser.add_argument("--no-pipeline", action="store_const", const=False, dest="BUILD_PIPELINE",
+                        help="build targets one after another instead of overlapping downloads, scans and compiles")
+    parser.add_argument("--profile", action="store_const", const=True, dest="PROFILE_SLOWEST_TARGET",
+                        help=f"write cProfile output of the slowest target to {PROFILE_FILE} in the output directory")
+    parser.add_argument("--force", action="store_const", const=True, dest="FORCE_REBUILD",
+                        help="rebuild every target even if its inputs are unchanged")
+    parser.add_argument("--backend", choices=["nmlc", "native"], dest="NEWGRF_BACKEND",
+                        help="compile with nmlc or write the GRF directly")
+    parser.add_argument("--max-towns", type=int, dest="MAX_TOWNS", metavar="N",
+                        help="maximum number of town names per NewGRF")
+    parser.add_argument("--population-threshold", type=int, dest="POPULATION_THRESHOLD", metavar="N",
+                        help="skip towns with a smaller population")
+    parser.add_argument("--weight-curve", type=parse_weight_curve, dest="WEIGHT_CURVE", metavar="CURVE",
+                        help="how population maps to spawn chance: fourth_root, log, rank or an exponent such as 0.5")
+    parser.add_argument("--collapse-near-duplicates", action="store_const", const=True,
+                        dest="COLLAPSE_NEAR_DUPLICATES",
+                        help="keep only the most populous of names that differ in case, accents or abbreviations")
+    parser.add_argument("--fuzzy-near-duplicates", action="store_const", const=True, dest="FUZZY_NEAR_DUPLICATES",
+                        help="with --collapse-near-duplicates, also collapse long names one typo apart")
+    parser.add_argument("--world-quotas", choices=WORLD_QUOTA_MODES, dest="WORLD_QUOTAS",
+                        help="share the towns of the world target between countries by population, population "
+                             "capped at --world-quota-cap, or square root of population")
+    parser.add_argument("--world-quota-stratum", choices=["country", "admin1"], dest="WORLD_QUOTA_STRATUM",
+                        help="with --world-quotas, also share each country quota between its regions")
+    parser.add_argument("--world-quota-cap", type=float, dest="WORLD_QUOTA_CAP", metavar="SHARE",
+                        help="largest share of --max-towns a country gets with --world-quotas capped")
+    parser.add_argument("--world-quota-seed", type=int, dest="WORLD_QUOTA_SEED", metavar="SEED",
+                        help="seed that decides which countries get the towns left when quotas are rounded")
+    parser.add_argument("--sort", choices=["population", "name"], dest="sort",
+                        help="keep the most populous towns, or the first towns by name")
+    parser.add_argument("--merged-file", action="store_const", const=True, dest="MERGED_FILE_OVERRIDE",
+                        help="read every target from allCountries.txt instead of per-country files")
+    parser.add_argument("--no-multi-target-scan", action="store_const", const=False, dest="MULTI_TARGET_SCAN",
+                        help="read the data file separately for every target")
+    parser.add_argument("--no-cache", action="store_const", const=False, dest="USE_TOWN_CACHE",
+                        help="read the GeoNames text files instead of the town cache")
+    parser.add_argument("--extract-zips", action="store_const", const=False, dest="STREAM_FROM_ZIP",
+                        help="extract downloaded GeoNames zips instead of reading them directly")
+    parser.add_argument("--download-jobs", type=int, dest="DOWNLOAD_JOBS", metavar="N",
+                        help="number of data files downloaded at the same time")
+    parser.add_argument("--refresh-data", action="store_const", const=True, dest="REFRESH_DATA",
+                        help="download the data files that changed on the server since they were fetched")
+    parser.add_argument("--update-data", action="store_const", const=True, dest="UPDATE_DATA",
+                        help="apply the GeoNames daily modifications and deletions to the downloaded data files")
+    parser.add_argument("--languages", type=lambda value: [code.strip() for code in value.split(",") if code.strip()],
+                        dest="TOWN_NAME_LANGUAGES", metavar="CODES",
+                        help="also build GRFs with the town names in these GeoNames languages, e.g. ja,ru,zh")
+    parser.add_argument("--data-dir", dest="DATA_PATH", metavar="DIR",
+                        help="directory for downloaded GeoNames data")
+    parser.add_argument("--cache-dir", dest="CACHE_PATH", metavar="DIR",
+                        help="directory for the town cache (default: <data dir>/Cache)")
+    parser.add_argument("--output-dir", dest="SOURCE_FILES_PATH", metavar="DIR",
+                        help="directory for the generated NML, lang and GRF files")
+    parser.add_argument("--deploy-dir", dest="OPENTTD_DIR", metavar="DIR",
+                        help="directory the GRFs are copied to (default: the OpenTTD newgrf directory)")
+    parser.add_argument("--also-deploy-dir", action="append", dest="EXTRA_DEPLOY_DIRS", metavar="DIR",
+                        help="also deploy the GRFs to this directory, can be given more than once")
+    parser.add_argument("--no-hardlinks", action="store_const", const=False, dest="DEPLOY_HARDLINKS",
+                        help="always copy deployed GRFs instead of hardlinking them")
+    parser.add_argument("--no-openttd-dir", action="store_const", const=False, dest="USE_OPENTTD_DIR",
+                        help="copy the GRFs to the Output directory instead of the OpenTTD directory")
+    parser.add_argument("--id-file", dest="ID_FILE", metavar="FILE",
+                        help="file storing the GRF ID and version of every target")
+    parser.add_argument("--data-url", dest="DATA_URL", metavar="URL",
+                        help="base URL of the GeoNames dump")
+    parser.add_argument("--verbose", action="store_const", const=True, dest="VERBOSE_OUTPUT",
+                        help="print more detailed output")
+    parser.add_argument("--serve", metavar="[HOST:]PORT",
+                        help="run a build server that keeps the data in memory and answers "
+                             "GET /build?target=CODE with the GRF (or &format=nml); the targets are built first")
+    return parser.parse_args(argv)
+
+
+def load_settings(args):
+    settings = {}
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            settings.update(json.load(f))
+        if "WEIGHT_CURVE" in settings:
+            # Checked like --weight-curve
+            settings["WEIGHT_CURVE"] = parse_weight_curve(str(settings["WEIGHT_CURVE"]))
+    if args.sort is not None:
+        settings["SORT_BY_POPULATION"] = args.sort == "population"
+    for name in CONFIGURABLE_SETTINGS:
+        value = getattr(args, name, None)
+        if value is not None:
+            settings[name] = value
+    # Keep the cache inside a relocated data directory unless it was placed explicitly
+    if "DATA_PATH" in settings and "CACHE_PATH" not in settings:
+        settings["CACHE_PATH"] = os.path.join(settings["DATA_PATH"], "Cache")
+    return settings
+
+
+def main(argv=None):
+    global OPENTTD_DIR
+    args = parse_args(argv)
+    apply_settings(load_settings(args))
+    interactive = not args.non_interactive and sys.stdin.isatty()
+    if USE_OPENTTD_DIR and OPENTTD_DIR is None and interactive and not args.serve:
+        OPENTTD_DIR = ask_openttd_dir()
     if not os.path.exists(DATA_PATH):
         os.makedirs(DATA_PATH, exist_ok=True)
-    if not os.path.exists(os.path.join(BASE_PATH, "Source_Files")):
-        os.makedirs(os.path.join(BASE_PATH, "Source_Files"), exist_ok=True)
-    for file in LIST_OF_DATA_FILES:
-        file_text = file.replace(".zip", ".txt")
-        if not os.path.exists(os.path.join(DATA_PATH, file_text)):
-            download_data_files(file, DATA_URL + file)
-            print(f"Downloaded {file}")
-    if input("Do you want to use the data input list? (yes = y, no = n): ") == "y":
+    if not os.path.exists(SOURCE_FILES_PATH):
+        os.makedirs(SOURCE_FILES_PATH, exist_ok=True)
+    if args.serve:
+        serve(args.serve, args.targets)
+        return
+    if args.targets:
+        data_input = args.targets
+    elif not interactive or input("Do you want to use the data input list? (yes = y, no = n): ") == "y":
         data_input = get_input(DATA_INPUT)
     else:
         data_input = take_input()
     print(f"Data input list:/n{data_input}")
-    i = 0
-    for code in data_input:
-        country_code, region_codes, subregion_code = split_input(code)
-        process_country_region(country_code, region_codes, subregion_code)
-        i += 1
-        print(f"Processed {i} of {len(data_input)}")
+    start = time.perf_counter()
+    targets = [(code, split_input(code)) for code in data_input]
+    if BUILD_PIPELINE and BUILD_JOBS <= 1:
+        import asyncio
+
+        reports, shared_report = asyncio.run(run_build_pipeline(targets))
+    else:
+        # Downloads, updates and the multi-target scan are shared by all targets and reported separately
+        scan_errors = {}
+        with collect_build_stats() as shared_stats:
+            fetch_shared_data(targets)
+            if MULTI_TARGET_SCAN:
+                target_records = read_towns_for_targets([target for _, target in targets], scan_errors)
+            else:
+                target_records = [None] * len(targets)
+        reports = build_targets(targets, target_records, BUILD_JOBS, scan_errors)
+        shared_report = shared_stats.report()
+    profile_path = keep_slowest_profile(reports)
+    write_build_report({
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "wall_seconds": round(time.perf_counter() - start, 4),
+        "jobs": BUILD_JOBS,
+        "profile": profile_path,
+        "shared": shared_report,
+        "targets": reports,
+    })
+    failures = [(code, report["error"]) for (code, _), report in zip(targets, reports) if report["status"] == "failed"]
+    if failures:
+        print(f"{len(failures)} of {len(targets)} targets failed:")
+        for code, error in failures:
+            print(f"  {code or 'World'}: {error}")
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":